@@ -25,12 +25,542 @@ saving the results to an OMERO.table.
 """
 
 import omero.scripts as scripts
-from random import random
 import math
-from numpy import array
-from omero.gateway import BlitzGateway
+from collections import defaultdict
+from numpy import array, around, asarray, float64, int32, int64, \
+    linspace, mgrid, str_, zeros
 import omero
-from omero.rtypes import rlong, rdouble, rstring
+from omero.rtypes import rint, rlong, rdouble, rstring, unwrap
+
+
+LINE_LENGTHS_NS = "imperial.training.demo.lineLengths"
+AGGREGATES_NS = "imperial.training.demo.lineLengthAggregates"
+INTENSITIES_NS = "imperial.training.demo.shapeIntensities"
+EXPORT_NS = "imperial.training.demo.shapeTableExport"
+TEXTS_NS = "imperial.training.demo.shapeTexts"
+# Table metadata key recording the last Image flushed to a table
+CHECKPOINT_KEY = "lastImageId"
+# Table metadata key recording that a run finished every Image
+COMPLETE_KEY = "complete"
+# Prefix of table metadata keys recording the code of each shape text
+TEXT_KEY_PREFIX = "shapeText."
+# Number of rows read per call when reading a whole table
+READ_CHUNK_SIZE = 100000
+
+# The aggregate tables we maintain while rows are written.
+# Each entry is (table name suffix, key column names)
+AGGREGATE_KEYS = [
+    ("PerImage", ('imageId',)),
+    ("PerRoi", ('imageId', 'roiId')),
+    ("PerPlane", ('imageId', 'theZ', 'theT')),
+    ]
+
+
+def saveTableToDataset(conn, dataset, name, data, ns):
+    """
+    Creates a new OMERO.table from the columns in data and links it to the
+    Dataset as a File Annotation with the given namespace.
+
+    @param conn:        BlitzGateway connection
+    @param dataset:     DatasetWrapper to attach the table to
+    @param name:        Name of the new table
+    @param data:        List of omero.grid Columns, with values
+    @param ns:          Namespace of the File Annotation
+    @return:            The table's OriginalFile
+    """
+    table = conn.c.sf.sharedResources().newTable(1, name)
+    try:
+        table.initialize(data)
+        if len(data[0].values) > 0:
+            table.addData(data)
+        orig_file = table.getOriginalFile()
+    finally:
+        table.close()
+
+    linkTableToDataset(conn, dataset, orig_file, ns)
+    return orig_file
+
+
+def linkTableToDataset(conn, dataset, orig_file, ns):
+    """
+    Links the table's OriginalFile to the Dataset as a File Annotation with
+    the given namespace.
+    """
+    fileAnn = omero.model.FileAnnotationI()
+    fileAnn.setFile(omero.model.OriginalFileI(orig_file.getId(), False))
+    fileAnn.setNs(rstring(ns))
+    link = omero.model.DatasetAnnotationLinkI()
+    link.setParent(omero.model.DatasetI(dataset.getId(), False))
+    link.setChild(fileAnn)
+    conn.getUpdateService().saveAndReturnObject(link)
+
+
+def getTable(conn, dataset, name, columns, ns, resume=True):
+    """
+    Opens the most recent OMERO.table with this name that the current user
+    linked to the Dataset, if resume is True and that table is from a run
+    that was interrupted. Otherwise creates a new table with the given
+    columns and links it to the Dataset.
+    Since table names are deterministic, a re-run of an interrupted script
+    finds the tables of the previous run, while a re-run of a finished one
+    starts again.
+
+    @param conn:        BlitzGateway connection
+    @param dataset:     DatasetWrapper the table is linked to
+    @param name:        Name of the table
+    @param columns:     List of (empty) omero.grid Columns for a new table
+    @param ns:          Namespace of the File Annotation of a new table
+    @param resume:      If False, always create a new table
+    @return:            Tuple of (table, created, lastImageId) where
+                        lastImageId is the checkpoint of the last Image
+                        flushed to the table (0 for a new table)
+    """
+    if resume:
+        params = omero.sys.ParametersI()
+        params.add("name", rstring(name))
+        params.add("mimetype", rstring("OMERO.tables"))
+        params.add("did", rlong(dataset.getId()))
+        params.add("ownerId", rlong(conn.getUserId()))
+        params.page(0, 1)
+        query = "select f from FileAnnotation a join a.file as f" \
+            " where f.name=:name and f.mimetype=:mimetype" \
+            " and f.details.owner.id=:ownerId and a.id in" \
+            " (select l.child.id from DatasetAnnotationLink l" \
+            " where l.parent.id=:did) order by f.id desc"
+        files = conn.getQueryService().findAllByQuery(query, params)
+        if len(files) > 0:
+            table = conn.c.sf.sharedResources().openTable(files[0])
+            metadata = table.getAllMetadata()
+            if unwrap(metadata.get(COMPLETE_KEY)):
+                print "Previous run finished table %s. Starting again" % name
+                table.close()
+            else:
+                lastImageId = unwrap(metadata.get(CHECKPOINT_KEY)) or 0
+                print "Resuming table %s after Image: %s" \
+                    % (name, lastImageId)
+                return table, False, lastImageId
+
+    table = conn.c.sf.sharedResources().newTable(1, name)
+    table.initialize(columns)
+    linkTableToDataset(conn, dataset, table.getOriginalFile(), ns)
+    return table, True, 0
+
+
+def flushRows(table, data, imageId, metadata=None):
+    """
+    Adds the rows for an Image to the table and records the Image ID as the
+    table's checkpoint, so that a re-run can resume after this Image.
+    Any other metadata (key, rtype) needed to resume is saved first.
+    """
+    if len(data[0].values) > 0:
+        table.addData(data)
+    if metadata is not None:
+        for key, value in metadata:
+            table.setMetadata(key, value)
+    table.setMetadata(CHECKPOINT_KEY, rlong(imageId))
+
+
+def getShapeTextCodes(table):
+    """
+    Returns the dict of text: code for the shape texts recorded in the
+    table's metadata by previous flushes. The empty string is code 0.
+    """
+    codes = {"": 0}
+    for key, value in table.getAllMetadata().items():
+        if key.startswith(TEXT_KEY_PREFIX):
+            codes[unwrap(value)] = int(key[len(TEXT_KEY_PREFIX):])
+    return codes
+
+
+def saveShapeTextTable(conn, dataset, name, codes):
+    """
+    Saves the distinct shape texts as a small table of code, text that the
+    shapeTextCode column of the line lengths table refers to.
+    The width of the text column is that of the longest text.
+
+    @param codes:   Dict of text: code
+    """
+    texts = sorted(codes.keys(), key=lambda text: codes[text])
+    width = max([len(text) for text in texts] + [1])
+    data = [
+        omero.grid.LongColumn('code', '', [codes[text] for text in texts]),
+        omero.grid.StringColumn('text', '', width, texts),
+        ]
+    return saveTableToDataset(conn, dataset, name, data, TEXTS_NS)
+
+
+def addToAggregate(aggregates, key, value):
+    """
+    Updates the running [count, total, min, max] for key in aggregates
+
+    @param aggregates:  Dict of key: [count, total, min, max]
+    @param key:         Tuple of key values, e.g. (imageId, roiId)
+    @param value:       The measurement to add
+    """
+    agg = aggregates.get(key)
+    if agg is None:
+        aggregates[key] = [1, value, value, value]
+    else:
+        agg[0] += 1
+        agg[1] += value
+        agg[2] = min(agg[2], value)
+        agg[3] = max(agg[3], value)
+
+
+def saveAggregateTable(conn, dataset, name, keyNames, aggregates):
+    """
+    Writes the aggregates to a new OMERO.table (one row per key) and links
+    it to the Dataset, so that summaries can be read without scanning every
+    shape row.
+
+    @param conn:        BlitzGateway connection
+    @param dataset:     DatasetWrapper to attach the table to
+    @param name:        Name of the new table
+    @param keyNames:    Names of the key columns, in key order
+    @param aggregates:  Dict of key: [count, total, min, max]
+    @return:            The table's OriginalFile
+    """
+    keys = sorted(aggregates.keys())
+    values = [aggregates[k] for k in keys]
+    data = [omero.grid.LongColumn(n, '', [k[i] for k in keys])
+            for i, n in enumerate(keyNames)]
+    data.extend([
+        omero.grid.LongColumn('count', '', [v[0] for v in values]),
+        omero.grid.DoubleColumn('sum', '', [v[1] for v in values]),
+        omero.grid.DoubleColumn('mean', '', [v[1] / v[0] for v in values]),
+        omero.grid.DoubleColumn('min', '', [v[2] for v in values]),
+        omero.grid.DoubleColumn('max', '', [v[3] for v in values]),
+        ])
+
+    return saveTableToDataset(conn, dataset, name, data, AGGREGATES_NS)
+
+
+def parsePoints(points):
+    """
+    Returns an (N, 2) array of x, y from a Polygon's points string.
+    Handles both "x,y x,y ..." and the older "points[x,y, x,y] ..." format.
+    """
+    if "points[" in points:
+        points = points.split("points[", 1)[1].split("]", 1)[0]
+    coords = [float(v) for v in points.replace(",", " ").split()]
+    return array(coords).reshape(-1, 2)
+
+
+def getShapeGeometry(s):
+    """
+    Returns (shapeType, params) for shapes we can measure intensities under,
+    or None for other shapes.
+    Lines and Polygons give an (N, 2) array of points, Rectangles give
+    (x, y, width, height) and Ellipses give (cx, cy, rx, ry).
+    """
+    if type(s) == omero.model.LineI:
+        return "Line", array([[s.getX1().getValue(), s.getY1().getValue()],
+                              [s.getX2().getValue(), s.getY2().getValue()]])
+    if type(s) == omero.model.RectI:
+        return "Rect", (s.getX().getValue(), s.getY().getValue(),
+                        s.getWidth().getValue(), s.getHeight().getValue())
+    if type(s) == omero.model.EllipseI:
+        return "Ellipse", (s.getCx().getValue(), s.getCy().getValue(),
+                           s.getRx().getValue(), s.getRy().getValue())
+    if type(s) == omero.model.PolygonI and s.getPoints() is not None:
+        return "Polygon", parsePoints(s.getPoints().getValue())
+    return None
+
+
+def getBounds(shapeType, params):
+    """ Returns the bounding box (xMin, yMin, xMax, yMax) of the shape """
+    if shapeType == "Rect":
+        x, y, w, h = params
+        return x, y, x + w, y + h
+    if shapeType == "Ellipse":
+        cx, cy, rx, ry = params
+        return cx - rx, cy - ry, cx + rx, cy + ry
+    return (params[:, 0].min(), params[:, 1].min(),
+            params[:, 0].max(), params[:, 1].max())
+
+
+def pointsInPolygon(gx, gy, points):
+    """
+    Even-odd test of every grid point (gx, gy) against the polygon, one
+    vectorized pass per polygon edge.
+    """
+    inside = zeros(gx.shape, dtype=bool)
+    xj, yj = points[-1]
+    for xi, yi in points:
+        if yi != yj:    # horizontal edges are never crossed
+            crosses = ((yi > gy) != (yj > gy)) & \
+                (gx < (xj - xi) * (gy - yi) / (yj - yi) + xi)
+            inside ^= crosses
+        xj, yj = xi, yi
+    return inside
+
+
+def rasterizeShape(shapeType, params, tile):
+    """
+    Returns (rows, cols) index arrays of the pixels under the shape, relative
+    to the tile (x, y, width, height) that was fetched.
+    For Lines the pixels are in order along the line, giving the profile.
+    """
+    tileX, tileY, tileW, tileH = tile
+    if shapeType == "Line":
+        (x1, y1), (x2, y2) = params
+        n = int(math.ceil(math.hypot(x2 - x1, y2 - y1))) + 1
+        cols = around(linspace(x1, x2, n)).astype(int) - tileX
+        rows = around(linspace(y1, y2, n)).astype(int) - tileY
+    else:
+        xMin, yMin, xMax, yMax = getBounds(shapeType, params)
+        xMin = max(int(math.floor(xMin)), tileX)
+        yMin = max(int(math.floor(yMin)), tileY)
+        xMax = min(int(math.ceil(xMax)), tileX + tileW - 1)
+        yMax = min(int(math.ceil(yMax)), tileY + tileH - 1)
+        gy, gx = mgrid[yMin:yMax + 1, xMin:xMax + 1]
+        if shapeType == "Rect":
+            x, y, w, h = params
+            inside = (gx >= x) & (gx < x + w) & (gy >= y) & (gy < y + h)
+        elif shapeType == "Ellipse":
+            cx, cy, rx, ry = params
+            inside = ((gx - cx) / max(rx, 0.5)) ** 2 + \
+                ((gy - cy) / max(ry, 0.5)) ** 2 <= 1
+        else:
+            inside = pointsInPolygon(gx, gy, params)
+        cols = gx[inside] - tileX
+        rows = gy[inside] - tileY
+    keep = (cols >= 0) & (cols < tileW) & (rows >= 0) & (rows < tileH)
+    return rows[keep], cols[keep]
+
+
+def measureIntensities(image, shapes, cIndexes):
+    """
+    Measures the pixel intensities under each shape for each channel.
+    Shapes are grouped by (Z, C, T) so that each plane is fetched once (as the
+    tile covering all the shapes on it) and shared by every shape on it.
+
+    @param image:       ImageWrapper
+    @param shapes:      List of (roiId, shape) for the Image
+    @param cIndexes:    List of zero-based channel indexes to measure.
+                        Indexes not in the Image are ignored
+    @return:            List of (roiId, shapeId, shapeType, theZ, theC, theT,
+                        values) where values is a numpy array of the pixels
+                        under the shape (the profile for Lines)
+    """
+    sizeX = image.getSizeX()
+    sizeY = image.getSizeY()
+    cIndexes = [c for c in cIndexes if 0 <= c < image.getSizeC()]
+
+    planes = {}
+    for roiId, s in shapes:
+        geometry = getShapeGeometry(s)
+        if geometry is None:
+            continue
+        z = s.getTheZ() is not None and s.getTheZ().getValue() or 0
+        t = s.getTheT() is not None and s.getTheT().getValue() or 0
+        for c in cIndexes:
+            planes.setdefault((z, c, t), []).append(
+                (roiId, s.getId().getValue(), geometry))
+
+    # the union of the bounding boxes of shapes on each plane
+    zctTileList = []
+    for (z, c, t), planeShapes in sorted(planes.items()):
+        bounds = array([getBounds(*g) for r, sid, g in planeShapes])
+        x = max(int(math.floor(bounds[:, 0].min())), 0)
+        y = max(int(math.floor(bounds[:, 1].min())), 0)
+        x2 = min(int(math.ceil(bounds[:, 2].max())), sizeX - 1)
+        y2 = min(int(math.ceil(bounds[:, 3].max())), sizeY - 1)
+        if x2 >= x and y2 >= y:
+            zctTileList.append((z, c, t, (x, y, x2 - x + 1, y2 - y + 1)))
+
+    results = []
+    if len(zctTileList) == 0:
+        return results
+    # A generator (not all tiles in hand)
+    tiles = image.getPrimaryPixels().getTiles(zctTileList)
+    for i, tileData in enumerate(tiles):
+        z, c, t, tile = zctTileList[i]
+        for roiId, shapeId, (shapeType, params) in planes[(z, c, t)]:
+            rows, cols = rasterizeShape(shapeType, params, tile)
+            values = tileData[rows, cols].astype(float64)
+            results.append((roiId, shapeId, shapeType, z, c, t, values))
+    return results
+
+
+def readTableColumns(table, chunkSize=READ_CHUNK_SIZE):
+    """
+    Reads every column of the OMERO.table into numpy arrays, paging through
+    the rows chunkSize at a time so that no single call is too large.
+
+    @return:    List of (name, array) in column order
+    """
+    headers = table.getHeaders()
+    colNumbers = range(len(headers))
+    rowCount = table.getNumberOfRows()
+    values = [[] for h in headers]
+    for start in range(0, rowCount, chunkSize):
+        stop = min(start + chunkSize, rowCount)
+        data = table.read(colNumbers, start, stop)
+        for i, col in enumerate(data.columns):
+            values[i].extend(col.values)
+
+    columns = []
+    for h, v in zip(headers, values):
+        if isinstance(h, omero.grid.DoubleColumn):
+            columns.append((h.name, asarray(v, dtype=float64)))
+        elif isinstance(h, omero.grid.StringColumn):
+            columns.append((h.name, asarray(v, dtype=object)))
+        else:
+            columns.append((h.name, asarray(v, dtype=int64)))
+    return columns
+
+
+def writeParquet(columns, path, dictionaries=None, memoryMappable=False):
+    """
+    Writes the columns as a Parquet file, compressed by column, or as an
+    uncompressed Arrow IPC file that can be memory-mapped for zero-copy
+    reads if memoryMappable is True.
+    Columns of codes in dictionaries are written as dictionary columns of
+    their values, under the dictionary's name.
+
+    @param dictionaries:    Dict of column name: (name, list of values by
+                            code)
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    dictionaries = dictionaries or {}
+    names = []
+    arrays = []
+    for n, v in columns:
+        if n in dictionaries:
+            n, values = dictionaries[n]
+            arrays.append(pa.DictionaryArray.from_arrays(
+                pa.array(v.astype(int32)), pa.array(values)))
+        else:
+            arrays.append(pa.array(v.tolist() if v.dtype == object else v))
+        names.append(n)
+    arrowTable = pa.Table.from_arrays(arrays, names)
+    if memoryMappable:
+        writer = pa.RecordBatchFileWriter(path, arrowTable.schema)
+        try:
+            writer.write_table(arrowTable)
+        finally:
+            writer.close()
+    else:
+        pq.write_table(arrowTable, path, compression="snappy")
+
+
+def writeHdf5(columns, path, dictionaries=None):
+    """
+    Writes each column as a chunked, gzip compressed HDF5 dataset.
+    Columns of codes in dictionaries are written as they are, with a
+    dataset of the values by code under the dictionary's name.
+
+    @param dictionaries:    Dict of column name: (name, list of values by
+                            code)
+    """
+    import h5py
+
+    columns = list(columns)
+    for n, (name, values) in (dictionaries or {}).items():
+        columns.append((name, asarray(values, dtype=object)))
+    f = h5py.File(path, "w")
+    try:
+        for name, v in columns:
+            if v.dtype == object:
+                v = v.astype(str_)
+            if len(v) > 0:
+                f.create_dataset(name, data=v, chunks=True,
+                                 compression="gzip", shuffle=True)
+            else:
+                f.create_dataset(name, data=v)
+    finally:
+        f.close()
+
+
+# Export formats: name: (file extension, mimetype, writer)
+EXPORT_FORMATS = {
+    "Parquet": (".parquet", "application/x-parquet", writeParquet),
+    "Arrow": (".arrow", "application/vnd.apache.arrow.file",
+              lambda columns, path, dictionaries=None:
+              writeParquet(columns, path, dictionaries, True)),
+    "HDF5": (".h5", "application/x-hdf", writeHdf5),
+    }
+
+
+def exportTable(conn, dataset, table, name, formats, dictionaries=None):
+    """
+    Exports the OMERO.table to columnar files in each of the formats and
+    attaches them to the Dataset as File Annotations, for loading into
+    pandas, Dask etc. without paging through the tables API.
+
+    @param conn:            BlitzGateway connection
+    @param dataset:         DatasetWrapper to attach the files to
+    @param table:           The OMERO.table to export
+    @param name:            Name of the files, without extension
+    @param formats:         List of keys of EXPORT_FORMATS
+    @param dictionaries:    Dict of column name: (name, list of values by
+                            code) for dictionary encoded columns
+    """
+    if len(formats) == 0:
+        return
+    columns = readTableColumns(table)
+    for fmt in formats:
+        ext, mimetype, writer = EXPORT_FORMATS[fmt]
+        path = name + ext
+        # The writers import their optional library when they are called
+        try:
+            writer(columns, path, dictionaries)
+        except ImportError as e:
+            print "%s. Can't export %s to %s" % (e, name, fmt)
+            continue
+        print "Exported %s rows to %s" % (table.getNumberOfRows(), path)
+        fileAnn = conn.createFileAnnfromLocalFile(
+            path, mimetype=mimetype, ns=EXPORT_NS)
+        dataset.linkAnnotation(fileAnn)
+
+
+def lineLengthColumns(rows):
+    """
+    Returns the columns of the line lengths table, with values from the dict
+    of column name: list of values. Use defaultdict(list) for empty columns.
+    Shape texts are dictionary encoded: shapeTextCode refers to the code
+    column of the separate ShapeTexts table.
+    """
+    return [
+        omero.grid.LongColumn('imageId', '', rows['imageId']),
+        omero.grid.RoiColumn('roidId', '', rows['roiId']),
+        omero.grid.LongColumn('shapeId', '', rows['shapeId']),
+        omero.grid.LongColumn('theZ', '', rows['theZ']),
+        omero.grid.LongColumn('theT', '', rows['theT']),
+        omero.grid.DoubleColumn('lineLength', '', rows['lineLength']),
+        omero.grid.LongColumn('shapeTextCode', '', rows['shapeTextCode']),
+        ]
+
+
+def intensityColumns(rows):
+    """ Returns the columns of the shape intensities table """
+    return [
+        omero.grid.LongColumn('imageId', '', rows['imageId']),
+        omero.grid.LongColumn('roiId', '', rows['roiId']),
+        omero.grid.LongColumn('shapeId', '', rows['shapeId']),
+        omero.grid.StringColumn('shapeType', '', 16, rows['shapeType']),
+        omero.grid.LongColumn('theZ', '', rows['theZ']),
+        omero.grid.LongColumn('theC', '', rows['theC']),
+        omero.grid.LongColumn('theT', '', rows['theT']),
+        omero.grid.LongColumn('pixelCount', '', rows['pixelCount']),
+        omero.grid.DoubleColumn('mean', '', rows['mean']),
+        omero.grid.DoubleColumn('integratedDensity', '',
+                                rows['integratedDensity']),
+        ]
+
+
+def profileColumns(rows):
+    """ Returns the columns of the line profiles table """
+    return [
+        omero.grid.LongColumn('imageId', '', rows['imageId']),
+        omero.grid.LongColumn('shapeId', '', rows['shapeId']),
+        omero.grid.LongColumn('theC', '', rows['theC']),
+        omero.grid.LongColumn('position', '', rows['position']),
+        omero.grid.DoubleColumn('intensity', '', rows['intensity']),
+        ]
 
 
 def processData(conn, scriptParams):
@@ -39,48 +569,93 @@ def processData(conn, scriptParams):
     an OMERO.table.
     Also calculate the average of all lines for each Image and add this as a
     Double Annotation on Image.
+    Per-Image, per-ROI and per-plane (Z, T) summaries are accumulated as the
+    rows are collected and saved as small aggregate tables on the Dataset.
+    If 'Measure_Intensities' is True, the pixel intensities under Lines,
+    Rectangles, Ellipses and Polygons are also measured and saved to a
+    'ShapeIntensities' table, with the intensity profile of each Line saved
+    to a 'LineProfiles' table.
+    Rows are flushed to the tables one Image at a time, in order of Image ID,
+    and each table records the last Image flushed. If 'Resume' is True, a
+    re-run continues from the tables of an interrupted run, skipping the
+    Images that are already done. Tables of a finished run are marked as
+    complete and are never resumed.
     """
 
     datasetIds = scriptParams['IDs']
+    measureInts = scriptParams.get('Measure_Intensities', False)
+    # Convert to zero-based indexes
+    cIndexes = [c - 1 for c in scriptParams.get('Channels_To_Measure', [1])]
+    resume = scriptParams.get('Resume', True)
+    exportFormats = scriptParams.get('Export_Formats', [])
+
     for dataset in conn.getObjects("Dataset", datasetIds):
 
-        # first create our table...
+        # first get our table, named by Dataset so a re-run can find it...
         # columns we want are: imageId, roiId, shapeId, theZ, theT,
-        # lineLength, shapetext.
-        columns = [
-            omero.grid.LongColumn('imageId', '', []),
-            omero.grid.RoiColumn('roidId', '', []),
-            omero.grid.LongColumn('shapeId', '', []),
-            omero.grid.LongColumn('theZ', '', []),
-            omero.grid.LongColumn('theT', '', []),
-            omero.grid.DoubleColumn('lineLength', '', []),
-            omero.grid.StringColumn('shapeText', '', 64, [])
-            ]
-        # create and initialize the table
-        table = conn.c.sf.sharedResources().newTable(
-            1, "LineLengths%s" % str(random()))
-        table.initialize(columns)
-
-        # make a local array of our data (add it to table in one go)
-        imageIds = []
-        roiIds = []
-        shapeIds = []
-        theZs = []
-        theTs = []
+        # lineLength, shapeTextCode.
+        table, created, checkpoint = getTable(
+            conn, dataset, "LineLengths_Dataset%s" % dataset.getId(),
+            lineLengthColumns(defaultdict(list)), LINE_LENGTHS_NS, resume)
+        # text: code for the distinct shape texts
+        shapeTextCodes = getShapeTextCodes(table)
+
+        # running [count, total, min, max] for each aggregate table
+        aggregates = dict([(a[0], {}) for a in AGGREGATE_KEYS])
         lineLengths = []
-        shapeTexts = []
+
+        def addLength(imageId, roiId, theZ, theT, length):
+            lineLengths.append(length)
+            keyValues = {'imageId': imageId, 'roiId': roiId, 'theZ': theZ,
+                         'theT': theT}
+            for suffix, keyNames in AGGREGATE_KEYS:
+                key = tuple([keyValues[n] for n in keyNames])
+                addToAggregate(aggregates[suffix], key, length)
+
+        # Rebuild the summaries of Images done by a previous run
+        rowCount = table.getNumberOfRows()
+        for start in range(0, rowCount, READ_CHUNK_SIZE):
+            stop = min(start + READ_CHUNK_SIZE, rowCount)
+            # imageId, roidId, theZ, theT, lineLength
+            done = table.read([0, 1, 3, 4, 5], start, stop)
+            for row in zip(*[col.values for col in done.columns]):
+                addLength(*row)
+
+        # Intensity tables keep their own checkpoints
+        lineCheckpoint = checkpoint
+        intTables = []
+        if measureInts:
+            for name, getColumns in [("ShapeIntensities", intensityColumns),
+                                     ("LineProfiles", profileColumns)]:
+                t, tCreated, tCheckpoint = getTable(
+                    conn, dataset, "%s_Dataset%s" % (name, dataset.getId()),
+                    getColumns(defaultdict(list)), INTENSITIES_NS, resume)
+                intTables.append((t, tCheckpoint, getColumns))
+                checkpoint = min(checkpoint, tCheckpoint)
+
         roiService = conn.getRoiService()
-        lengthsForImage = []
-        for image in dataset.listChildren():
+        images = sorted(dataset.listChildren(), key=lambda i: i.getId())
+        for image in images:
+            if image.getId() <= checkpoint:
+                continue    # already done by a previous run
+            # Lines may be done and only the intensities behind
+            doLines = image.getId() > lineCheckpoint
+
+            # make a local array of this Image's data (flush it in one go)
+            rows = defaultdict(list)
+            newTexts = []
+            lengthsForImage = []
             result = roiService.findByImage(image.getId(), None)
+            imageShapes = []
             for roi in result.rois:
                 for s in roi.copyShapes():
-                    if type(s) == omero.model.LineI:
-                        imageIds.append(image.getId())
-                        roiIds.append(roi.getId().getValue())
-                        shapeIds.append(s.getId().getValue())
-                        theZs.append(s.getTheZ().getValue())
-                        theTs.append(s.getTheT().getValue())
+                    imageShapes.append((roi.getId().getValue(), s))
+                    if type(s) == omero.model.LineI and doLines:
+                        rows['imageId'].append(image.getId())
+                        rows['roiId'].append(roi.getId().getValue())
+                        rows['shapeId'].append(s.getId().getValue())
+                        rows['theZ'].append(s.getTheZ().getValue())
+                        rows['theT'].append(s.getTheT().getValue())
                         x1 = s.getX1().getValue()
                         x2 = s.getX2().getValue()
                         y1 = s.getY1().getValue()
@@ -88,50 +663,98 @@ def processData(conn, scriptParams):
                         x = x1 - x2
                         y = y1 - y2
                         length = math.sqrt(math.pow(x, 2) + math.pow(y, 2))
-                        lineLengths.append(length)
+                        rows['lineLength'].append(length)
                         lengthsForImage.append(length)
+                        addLength(image.getId(), rows['roiId'][-1],
+                                  rows['theZ'][-1], rows['theT'][-1], length)
+                        text = ""
                         if s.getTextValue():
-                            shapeTexts.append(s.getTextValue().getValue())
-                        else:
-                            shapeTexts.append("")
+                            text = s.getTextValue().getValue()
+                        if text not in shapeTextCodes:
+                            shapeTextCodes[text] = len(shapeTextCodes)
+                            newTexts.append(text)
+                        rows['shapeTextCode'].append(shapeTextCodes[text])
+
+            if measureInts:
+                intensities = defaultdict(list)
+                profiles = defaultdict(list)
+                for roiId, shapeId, shapeType, z, c, t, values in \
+                        measureIntensities(image, imageShapes, cIndexes):
+                    count = len(values)
+                    total = values.sum()
+                    row = [('imageId', image.getId()), ('roiId', roiId),
+                           ('shapeId', shapeId), ('shapeType', shapeType),
+                           ('theZ', z), ('theC', c), ('theT', t),
+                           ('pixelCount', count),
+                           ('mean', total / max(count, 1)),
+                           ('integratedDensity', total)]
+                    for name, v in row:
+                        intensities[name].append(v)
+                    if shapeType == "Line":
+                        profiles['imageId'].extend([image.getId()] * count)
+                        profiles['shapeId'].extend([shapeId] * count)
+                        profiles['theC'].extend([c] * count)
+                        profiles['position'].extend(range(count))
+                        profiles['intensity'].extend(values.tolist())
+                for (t, tCheckpoint, getColumns), tRows in \
+                        zip(intTables, [intensities, profiles]):
+                    if image.getId() > tCheckpoint:
+                        flushRows(t, getColumns(tRows), image.getId())
+
+            if not doLines:
+                continue
             if len(lengthsForImage) == 0:
                 print "No lines found on Image:", image.getName()
-                continue
-            imgAverage = sum(lengthsForImage) / len(lengthsForImage)
-            print "Average length of line for Image: %s is %s" \
-                % (image.getName(), imgAverage)
-
-            # Add the average as an annotation on each image.
-            lengthAnn = omero.model.DoubleAnnotationI()
-            lengthAnn.setDoubleValue(rdouble(imgAverage))
-            lengthAnn.setNs(rstring(
-                "imperial.training.demo.lineLengthAverage"))
-            link = omero.model.ImageAnnotationLinkI()
-            link.setParent(omero.model.ImageI(image.getId(), False))
-            link.setChild(lengthAnn)
-            conn.getUpdateService().saveAndReturnObject(link)
-            lengthsForImage = []    # reset for next image.
-
-        # Prepare data for adding to OMERO table.
-        data = [
-            omero.grid.LongColumn('imageId', '', imageIds),
-            omero.grid.RoiColumn('roidId', '', roiIds),
-            omero.grid.LongColumn('shapeId', '', shapeIds),
-            omero.grid.LongColumn('theZ', '', theZs),
-            omero.grid.LongColumn('theT', '', theTs),
-            omero.grid.DoubleColumn('lineLength', '', lineLengths),
-            omero.grid.StringColumn('shapeText', '', 64, shapeTexts),
-            ]
-        table.addData(data)
+            else:
+                imgAverage = sum(lengthsForImage) / len(lengthsForImage)
+                print "Average length of line for Image: %s is %s" \
+                    % (image.getName(), imgAverage)
 
-        # get the table as an original file & attach this data to Dataset
-        orig_file = table.getOriginalFile()
-        fileAnn = omero.model.FileAnnotationI()
-        fileAnn.setFile(orig_file)
-        link = omero.model.DatasetAnnotationLinkI()
-        link.setParent(omero.model.DatasetI(dataset.getId(), False))
-        link.setChild(fileAnn)
-        #conn.getUpdateService().saveAndReturnObject(link)
+                # Add the average as an annotation on each image.
+                lengthAnn = omero.model.DoubleAnnotationI()
+                lengthAnn.setDoubleValue(rdouble(imgAverage))
+                lengthAnn.setNs(rstring(
+                    "imperial.training.demo.lineLengthAverage"))
+                link = omero.model.ImageAnnotationLinkI()
+                link.setParent(omero.model.ImageI(image.getId(), False))
+                link.setChild(lengthAnn)
+                conn.getUpdateService().saveAndReturnObject(link)
+
+            # Add this Image's data to the OMERO table & checkpoint
+            textMetadata = [(TEXT_KEY_PREFIX + str(shapeTextCodes[nt]),
+                             rstring(nt)) for nt in newTexts]
+            flushRows(table, lineLengthColumns(rows), image.getId(),
+                      textMetadata)
+
+        saveShapeTextTable(conn, dataset,
+                           "ShapeTexts_Dataset%s" % dataset.getId(),
+                           shapeTextCodes)
+
+        # Export the tables for downstream analysis
+        # the shape texts by code, so that exports keep the text
+        texts = sorted(shapeTextCodes.keys(), key=shapeTextCodes.get)
+        exportTable(conn, dataset, table,
+                    "LineLengths_Dataset%s" % dataset.getId(), exportFormats,
+                    {'shapeTextCode': ('shapeText', texts)})
+        for t, tCheckpoint, getColumns in intTables:
+            exportTable(conn, dataset, t, t.getOriginalFile().getName().val,
+                        exportFormats)
+            t.setMetadata(COMPLETE_KEY, rlong(1))
+            t.close()
+
+        # Save the summaries we built up alongside the rows
+        for suffix, keyNames in AGGREGATE_KEYS:
+            name = "LineLengths%s_Dataset%s" % (suffix, dataset.getId())
+            saveAggregateTable(
+                conn, dataset, name, keyNames, aggregates[suffix])
+
+        # Every Image is done, so a re-run starts a new table
+        table.setMetadata(COMPLETE_KEY, rlong(1))
+
+        if len(lineLengths) == 0:
+            print "No lines found in Dataset:", dataset.getName()
+            table.close()
+            continue
 
         a = array(lineLengths)
         print "std", a.std()
@@ -155,6 +778,11 @@ def processData(conn, scriptParams):
                 print "Query Results for Column: ", col.name
                 for v in col.values:
                     print "   ", v
+        table.close()
+
+
+# The function doing the work of the script, also called by run_batch
+WORK_FUNCTION = processData
 
 
 def runAsScript():
@@ -164,6 +792,7 @@ def runAsScript():
     """
 
     dataTypes = [rstring('Dataset')]
+    exportFormats = [rstring(f) for f in sorted(EXPORT_FORMATS.keys())]
 
     client = scripts.client(
         'Shapes_To_Table.py',
@@ -180,6 +809,27 @@ and saving the results to an OMERO.table.""",
             description="List of Dataset IDs to convert to new"
             " Plates.").ofType(rlong(0)),
 
+        scripts.Bool(
+            "Measure_Intensities", grouping="3", default=False,
+            description="Also measure pixel intensities under Lines,"
+            " Rectangles, Ellipses and Polygons"),
+
+        scripts.List(
+            "Channels_To_Measure", grouping="3.1",
+            description="Channels to measure intensities in (1 is the first"
+            " channel). Default is first channel").ofType(rint(0)),
+
+        scripts.Bool(
+            "Resume", grouping="4", default=True,
+            description="Continue from the tables of a previous run that was"
+            " interrupted, skipping Images that are already done"),
+
+        scripts.List(
+            "Export_Formats", grouping="5",
+            description="Also export the tables to these columnar file"
+            " formats, attached to the Dataset", values=exportFormats
+            ).ofType(rstring("")),
+
         version="4.4.8",
         authors=["William Moore", "OME Team"],
         institutions=["University of Dundee"],
@@ -187,23 +837,21 @@ and saving the results to an OMERO.table.""",
     )
 
     try:
-
-        # process the list of args above.
+        # process the list of args above, fetching each input once
         scriptParams = {}
         for key in client.getInputKeys():
-            if client.getInput(key):
-                scriptParams[key] = client.getInput(key, unwrap=True)
-
+            value = client.getInput(key)
+            if value:
+                scriptParams[key] = unwrap(value)
         print scriptParams
 
         # wrap client to use the Blitz Gateway
+        from omero.gateway import BlitzGateway
         conn = BlitzGateway(client_obj=client)
 
         # process images in Datasets
         processData(conn, scriptParams)
 
-        #client.setOutput("Message", rstring("No plates created. See 'Error'
-        # or 'Info' for details"))
     finally:
         client.closeSession()
 
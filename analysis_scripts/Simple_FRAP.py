@@ -31,9 +31,7 @@ analysis, and needs at least 1 pre-bleach frame.
 
 import omero
 import omero.scripts as scripts
-from omero.rtypes import rint, rlong, rstring
-from omero.gateway import BlitzGateway
-import omero.util.script_utils as scriptUtil
+from omero.rtypes import rint, rlong, rstring, unwrap
 
 
 # To keep things simple, we'll work with a single Ellipse per T
@@ -208,6 +206,7 @@ def analyseImage(conn, image, cIndex):
     f.writelines(csvLines)
     f.close()
 
+    import omero.util.script_utils as scriptUtil
     namespace = "/omero-user-scripts/example/Simple_FRAP/"
     scriptUtil.createLinkFileAnnotation(conn, "FRAP.csv", image, ns=namespace)
 
@@ -231,6 +230,25 @@ def doFrapAnalysis(conn, scriptParams):
     return results
 
 
+def frapAnalysis(conn, scriptParams):
+    """ Does the FRAP analysis and returns a message of the t-half results """
+
+    results = doFrapAnalysis(conn, scriptParams)
+    if len(results) == 1:
+        message = "FRAP tHalf: %0.2f seconds" % results[0]
+    elif len(results) == 0:
+        message = "No Images Analysed. See Info for more details"
+    else:
+        average = sum(results)/len(results)
+        message = "Average FRAP t-half (%s images): %0.2f seconds. " \
+            % (len(results), average)
+    return message
+
+
+# The function doing the work of the script, also called by run_batch
+WORK_FUNCTION = frapAnalysis
+
+
 def runAsScript():
     """
     The main entry point of the script, as called by the client via the
@@ -267,30 +285,20 @@ analysed.
     )
 
     try:
-
-        # process the list of args above.
+        # process the list of args above, fetching each input once
         scriptParams = {}
         for key in client.getInputKeys():
-            if client.getInput(key):
-                scriptParams[key] = client.getInput(key, unwrap=True)
-
+            value = client.getInput(key)
+            if value:
+                scriptParams[key] = unwrap(value)
         print scriptParams
 
         # wrap client to use the Blitz Gateway
+        from omero.gateway import BlitzGateway
         conn = BlitzGateway(client_obj=client)
 
-        # process images in Datasets
-        results = doFrapAnalysis(conn, scriptParams)
-        if len(results) == 1:
-            message = "FRAP tHalf: %0.2f seconds" % results[0]
-        elif len(results) == 0:
-            message = "No Images Analysed. See Info for more details"
-        else:
-            average = sum(results)/len(results)
-            message = "Average FRAP t-half (%s images): %0.2f seconds. " \
-                % (len(results), average)
-
-        # Return the output - display Message:
+        # process images and return the output - display Message:
+        message = frapAnalysis(conn, scriptParams)
         client.setOutput("Message", rstring(message))
 
     finally:
@@ -24,12 +24,242 @@ Copy Tags from Datasets or Images and apply them to the
 child images of the Dataset and/or other Datasets / Images
 """
 
+import omero
 import omero.scripts as scripts
-from omero.gateway import BlitzGateway
-from omero.rtypes import rstring, rlong
+from collections import defaultdict
+from itertools import chain
+from omero.rtypes import rstring, rlong, rlist, unwrap
 
 
 dataTypes = [rstring('Dataset'), rstring('Image')]
+syncModes = [rstring('Add'), rstring('Mirror'), rstring('Remove')]
+
+# Max number of IDs in a single 'in (:ids)' query clause
+QUERY_CHUNK_SIZE = 1000
+
+
+def chunks(ids, size):
+    """ Yields successive lists of up to size items from ids """
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+
+def getExistingLinks(conn, objType, objIds, tagIds=None):
+    """
+    Returns a dict of (objectId, tagId): linkId for all the Tag links that
+    already exist on the objects, using one projection query per chunk of
+    objects instead of one query per (object, tag) pair.
+
+    @param conn:        BlitzGateway connection
+    @param objType:     'Dataset' or 'Image'
+    @param objIds:      List of object IDs
+    @param tagIds:      List of Tag IDs. If None, get links to any Tag
+    """
+    qs = conn.getQueryService()
+    query = "select l.id, l.parent.id, t.id from %sAnnotationLink l," \
+        " TagAnnotation t where l.child.id = t.id and l.parent.id in (:ids)" \
+        % objType
+    if tagIds is not None:
+        query += " and t.id in (:tagIds)"
+    existing = {}
+    for ids in chunks(objIds, QUERY_CHUNK_SIZE):
+        params = omero.sys.ParametersI()
+        params.addIds(ids)
+        if tagIds is not None:
+            params.add("tagIds", rlist([rlong(t) for t in tagIds]))
+        for row in qs.projection(query, params, conn.SERVICE_OPTS):
+            existing[(row[1].val, row[2].val)] = row[0].val
+    return existing
+
+
+def getSourceTags(conn, objType, objIds):
+    """
+    Returns a dict of tagId: textValue for the distinct Tags on any of the
+    objects, using a projection query that only looks at Tag annotations
+    (not files, comments etc) and returns each Tag once.
+
+    @param conn:        BlitzGateway connection
+    @param objType:     'Dataset' or 'Image'
+    @param objIds:      List of object IDs
+    """
+    qs = conn.getQueryService()
+    query = "select distinct t.id, t.textValue from TagAnnotation t" \
+        " where t.id in (select l.child.id from %sAnnotationLink l" \
+        " where l.parent.id in (:ids))" % objType
+    tags = {}
+    for ids in chunks(objIds, QUERY_CHUNK_SIZE):
+        params = omero.sys.ParametersI()
+        params.addIds(ids)
+        for row in qs.projection(query, params, conn.SERVICE_OPTS):
+            tags[row[0].val] = row[1] is not None and row[1].val or ""
+    return tags
+
+
+def iterChildImageIds(conn, datasetIds, pageSize=QUERY_CHUNK_SIZE):
+    """
+    Yields lists of the IDs of Images in the Datasets, one page at a time,
+    so that we never load all the ImageWrappers of a huge Dataset.
+
+    @param conn:        BlitzGateway connection
+    @param datasetIds:  List of Dataset IDs
+    @param pageSize:    Number of Image IDs per page
+    """
+    qs = conn.getQueryService()
+    query = "select distinct l.child.id from DatasetImageLink l" \
+        " where l.parent.id in (:ids) order by l.child.id"
+    offset = 0
+    while True:
+        params = omero.sys.ParametersI()
+        params.addIds(datasetIds)
+        params.page(offset, pageSize)
+        ids = [row[0].val for row in
+               qs.projection(query, params, conn.SERVICE_OPTS)]
+        if len(ids) == 0:
+            break
+        yield ids
+        if len(ids) < pageSize:
+            break
+        offset += pageSize
+
+
+def newReport(tags, sampleSize=0):
+    """
+    Returns a dict for collecting summary counts of the tagging, instead of
+    printing a line for every (object, tag). Counts are per target type and
+    per Tag, with up to sampleSize lines of detail.
+
+    @param tags:        Dict of tagId: textValue for the Tag names
+    @param sampleSize:  Max number of detail lines to keep
+    """
+    return {'tags': tags, 'sampleSize': sampleSize, 'samples': [],
+            'added': defaultdict(int), 'present': defaultdict(int),
+            'removed': defaultdict(int), 'tagAdded': defaultdict(int),
+            'tagRemoved': defaultdict(int)}
+
+
+def addToReport(report, objType, toCreate, skipped, toDelete):
+    """
+    Adds the links created, already present and deleted for one batch of
+    objects to the report.
+
+    @param toCreate:    List of (objectId, tagId)
+    @param skipped:     Number of links already present
+    @param toDelete:    List of ((objectId, tagId), linkId)
+    """
+    report['added'][objType] += len(toCreate)
+    report['present'][objType] += skipped
+    report['removed'][objType] += len(toDelete)
+    for oid, tid in toCreate:
+        report['tagAdded'][tid] += 1
+    for (oid, tid), linkId in toDelete:
+        report['tagRemoved'][tid] += 1
+
+    samples = report['samples']
+    tags = report['tags']
+    for oid, tid in toCreate[:report['sampleSize'] - len(samples)]:
+        samples.append("Adding Tag: %s to %s %s"
+                       % (tags.get(tid, tid), objType, oid))
+    for (oid, tid), linkId in \
+            toDelete[:report['sampleSize'] - len(samples)]:
+        samples.append("Removing Tag: %s from %s %s"
+                       % (tags.get(tid, tid), objType, oid))
+
+
+def printReport(report, dryRun=False):
+    """
+    Prints the summary of the report and returns a short message for the
+    user.
+    """
+    prefix = dryRun and "[Dry run] " or ""
+    if len(report['samples']) > 0:
+        print "%sSample of changes:" % prefix
+        for line in report['samples']:
+            print "  ", line
+    tags = report['tags']
+    for tid in sorted(set(report['tagAdded'].keys() +
+                          report['tagRemoved'].keys())):
+        print "%sTag: %s  added to %s, removed from %s" \
+            % (prefix, tags.get(tid, tid), report['tagAdded'][tid],
+               report['tagRemoved'][tid])
+
+    message = prefix
+    for objType in sorted(report['added'].keys()):
+        print "%s%s: added %s Tag links, %s already present, %s removed" \
+            % (prefix, objType, report['added'][objType],
+               report['present'][objType], report['removed'][objType])
+        message += "%s: %s added, %s removed. " \
+            % (objType, report['added'][objType], report['removed'][objType])
+    return message + "See info for details"
+
+
+def syncTags(conn, objType, objIds, tags, mode="Add", removeExtra=False,
+             batchSize=1000, dryRun=False, report=None):
+    """
+    Makes the Tags on the objects match the source tags, with the fewest
+    writes. The existing Tag links of all the objects are fetched in bulk
+    and the links to create and delete are computed as a set difference
+    in memory, then saved or deleted in batches of batchSize.
+
+    Modes are:
+        'Add':      Link each of the tags to each object, unless linked.
+        'Mirror':   As 'Add', and if removeExtra is True also remove links
+                    to any other Tags, so the objects have exactly the tags.
+        'Remove':   Remove the links between the objects and the tags.
+
+    @param conn:        BlitzGateway connection
+    @param objType:     'Dataset' or 'Image'
+    @param objIds:      List of object IDs
+    @param tags:        Dict of tagId: textValue
+    @param mode:        'Add', 'Mirror' or 'Remove'
+    @param removeExtra: In 'Mirror' mode, remove links to other Tags
+    @param batchSize:   Number of links to save or delete per call
+    @param dryRun:      If True, only report what would be done
+    @param report:      Dict from newReport() to add counts to
+    @return:            Tuple of (number of links created, number already
+                        present, number deleted)
+    """
+    if len(objIds) == 0:
+        return 0, 0, 0
+    allTags = mode == "Mirror" and removeExtra
+    if len(tags) == 0 and not allTags:
+        return 0, 0, 0
+    existing = getExistingLinks(conn, objType, objIds,
+                                None if allTags else tags.keys())
+    wanted = set()
+    if mode != "Remove":
+        wanted = set([(oid, tid) for oid in objIds for tid in tags])
+
+    toCreate = sorted(wanted.difference(existing))
+    if mode == "Remove":
+        toDelete = sorted(existing.items())
+    elif allTags:
+        toDelete = sorted([(pair, linkId) for pair, linkId in
+                           existing.items() if pair not in wanted])
+    else:
+        toDelete = []
+    skipped = len(wanted) - len(toCreate)
+
+    if report is not None:
+        addToReport(report, objType, toCreate, skipped, toDelete)
+    if dryRun:
+        return len(toCreate), skipped, len(toDelete)
+
+    updateService = conn.getUpdateService()
+    linkClass = getattr(omero.model, "%sAnnotationLinkI" % objType)
+    objClass = getattr(omero.model, "%sI" % objType)
+    for pairs in chunks(toCreate, batchSize):
+        links = []
+        for oid, tid in pairs:
+            link = linkClass()
+            link.setParent(objClass(oid, False))
+            link.setChild(omero.model.TagAnnotationI(tid, False))
+            links.append(link)
+        updateService.saveArray(links, conn.SERVICE_OPTS)
+    for items in chunks(toDelete, batchSize):
+        handle = conn.deleteObjects("%sAnnotationLink" % objType,
+                                    [linkId for pair, linkId in items])
+        conn._waitOnCmd(handle)
+    return len(toCreate), skipped, len(toDelete)
 
 
 def copyAndPasteTags(conn, scriptParams):
@@ -43,96 +273,128 @@ def copyAndPasteTags(conn, scriptParams):
         to_ids = scriptParams["Paste_To_IDs"]
 
     Paste_To_Contained_Images = scriptParams["Paste_To_Contained_Images"]
+    batchSize = scriptParams.get("Batch_Size", 1000)
+    mode = scriptParams.get("Sync_Mode", "Add")
+    removeExtra = scriptParams.get("Remove_Extra_Tags", False)
+    dryRun = scriptParams.get("Dry_Run", False)
+    detailLines = scriptParams.get("Detail_Lines", 0)
 
-    # The Tags we're going to apply
-    tags = []
-
-    # The Datasets or Images to add them to
+    # Pages of (type, IDs) of Datasets or Images to add them to
     apply_to = []
 
-    # Get Tags from input Objects
-    for obj in conn.getObjects(from_type, from_ids):
-        t = [ann for ann in obj.listAnnotations()
-             if ann._obj.__class__.__name__ == "TagAnnotationI"]
-        tags.extend(t)
-
-        # Also get the Child Images if we want to tag them
-        if Paste_To_Contained_Images and from_type == "Dataset":
-            for img in obj.listChildren():
-                apply_to.append(img)
+    # The Tags we're going to apply, from all the input Objects at once
+    tags = getSourceTags(conn, from_type, from_ids)
 
-    print "Tags", tags
+    print "Tags", tags.values()
 
     # If we're applying Tags to other objects, add them to the list
     if to_type is not None and len(to_ids) > 0:
-        for obj in conn.getObjects(to_type, to_ids):
-            apply_to.append(obj)
-
-    # Do the Tagging
-    for obj in apply_to:
-        for t in tags:
-            # Check the tag is not already on the object
-            if len(list(conn.getAnnotationLinks(obj.OMERO_CLASS,
-                   parent_ids=[obj.id], ann_ids=[t.id]))) == 0:
-                print "Adding Tag:", t.getValue(), " to ", \
-                    obj.OMERO_CLASS, obj.getName()
-                obj.linkAnnotation(t, sameOwner=False)
-            else:
-                print "** Tag:", t.getValue(), " already on ", \
-                    obj.OMERO_CLASS, obj.getName()
-
-client = scripts.client(
-    'Copy_And_Paste_Tags.py',
-    """Copy Tags from Datasets or Images and apply them to the \
+        ids = [obj.getId() for obj in conn.getObjects(to_type, to_ids)]
+        apply_to.append((to_type, ids))
+
+    # Also tag the Child Images, streaming their IDs a page at a time
+    if Paste_To_Contained_Images and from_type == "Dataset":
+        apply_to = chain(
+            apply_to, (("Image", ids) for ids in
+                       iterChildImageIds(conn, from_ids, batchSize)))
+
+    # Do the Tagging, counting what we do rather than printing each link
+    report = newReport(tags, detailLines)
+    for objType, objIds in apply_to:
+        syncTags(conn, objType, objIds, tags, mode, removeExtra, batchSize,
+                 dryRun, report)
+
+    return printReport(report, dryRun)
+
+
+# The function doing the work of the script, also called by run_batch
+WORK_FUNCTION = copyAndPasteTags
+
+
+def runScript():
+    """
+    The main entry point of the script, as called by the client via the
+    scripting service, passing the required parameters.
+    """
+
+    client = scripts.client(
+        'Copy_And_Paste_Tags.py',
+        """Copy Tags from Datasets or Images and apply them to the \
 child images of the Dataset and/or other Datasets / Images""",
 
-    scripts.String(
-        "Data_Type", optional=False, grouping="1",
-        description="The object type to Copy tags from.", values=dataTypes,
-        default="Dataset"),
-
-    scripts.List(
-        "IDs", optional=False, grouping="2",
-        description="IDs of Datasets or Images to Copy tags"
-        " from.").ofType(rlong(0)),
-
-    scripts.Bool(
-        "Paste_To_Contained_Images", grouping="3",
-        description="If Copying from Dataset, Add Tags to child Images?",
-        default=False),
-
-    scripts.Bool(
-        "Paste_To_Other_Datasets_Or_Images", grouping="4",
-        description="Can also choose other targets to paste the same tags",
-        default=False),
-
-    scripts.String(
-        "Paste_To_Type", grouping="4.1",
-        description="The object type to Paste tags to.", values=dataTypes,
-        default="Dataset"),
-
-    scripts.List(
-        "Paste_To_IDs", grouping="4.2",
-        description="IDs of Datasets or Images to Paste Tags"
-        " to.").ofType(rlong(0)),
+        scripts.String(
+            "Data_Type", optional=False, grouping="1",
+            description="The object type to Copy tags from.", values=dataTypes,
+            default="Dataset"),
+
+        scripts.List(
+            "IDs", optional=False, grouping="2",
+            description="IDs of Datasets or Images to Copy tags"
+            " from.").ofType(rlong(0)),
+
+        scripts.Bool(
+            "Paste_To_Contained_Images", grouping="3",
+            description="If Copying from Dataset, Add Tags to child Images?",
+            default=False),
+
+        scripts.Bool(
+            "Paste_To_Other_Datasets_Or_Images", grouping="4",
+            description="Can also choose other targets to paste the same tags",
+            default=False),
+
+        scripts.String(
+            "Paste_To_Type", grouping="4.1",
+            description="The object type to Paste tags to.", values=dataTypes,
+            default="Dataset"),
+
+        scripts.List(
+            "Paste_To_IDs", grouping="4.2",
+            description="IDs of Datasets or Images to Paste Tags"
+            " to.").ofType(rlong(0)),
+
+        scripts.Int(
+            "Batch_Size", grouping="5", default=1000, min=1,
+            description="Number of Tag links to save or delete in each call"),
+
+        scripts.String(
+            "Sync_Mode", grouping="6", values=syncModes, default="Add",
+            description="Add: paste the Tags. Mirror: also make the targets"
+            " match the sources. Remove: remove the Tags from the targets"),
+
+        scripts.Bool(
+            "Remove_Extra_Tags", grouping="6.1", default=False,
+            description="In Mirror mode, remove any other Tags from the"
+            " targets"),
+
+        scripts.Bool(
+            "Dry_Run", grouping="7", default=False,
+            description="Only report the Tags that would be added or removed"),
+
+        scripts.Int(
+            "Detail_Lines", grouping="8", default=0, min=0,
+            description="Number of individual Tag changes to list, as a"
+            " sample. Otherwise only summary counts are reported"),
     )
 
-try:
-
-    session = client.getSession()
-    scriptParams = {}
+    try:
+        # process the list of args above, fetching each input once
+        scriptParams = {}
+        for key in client.getInputKeys():
+            value = client.getInput(key)
+            if value:
+                scriptParams[key] = unwrap(value)
+        print scriptParams
 
-    conn = BlitzGateway(client_obj=client)
+        # wrap client to use the Blitz Gateway
+        from omero.gateway import BlitzGateway
+        conn = BlitzGateway(client_obj=client)
 
-    # process the list of args above.
-    for key in client.getInputKeys():
-        if client.getInput(key):
-            scriptParams[key] = client.getInput(key, unwrap=True)
-    print scriptParams
+        message = copyAndPasteTags(conn, scriptParams)
 
-    copyAndPasteTags(conn, scriptParams)
+        client.setOutput("Message", rstring(message))
 
-    client.setOutput("Message", rstring("Tagging DONE. See info for details"))
+    finally:
+        client.closeSession()
 
-finally:
-    client.closeSession()
+if __name__ == "__main__":
+    runScript()
@@ -26,105 +26,584 @@ from a number of parameters.
 
 import omero
 import omero.scripts as scripts
-from omero.gateway import BlitzGateway
-from omero.rtypes import rint, rdouble, rstring, wrap, unwrap
+from omero.rtypes import rint, rlong, rstring, wrap, unwrap
 
+import os
+import tempfile
+from cStringIO import StringIO
 from datetime import datetime
-
-
-def searchImages(conn, scriptParams):
+import operator
+
+
+# The joins the search can need, as alias: (alias joined from, property)
+JOINS = {
+    "pixels": ("i", "pixels"),
+    "c": ("pixels", "channels"),
+    "lc": ("c", "logicalChannel"),
+    "objS": ("i", "objectiveSettings"),
+    "ob": ("objS", "objective"),
+    }
+
+ID_SET_NS = "omero.user_scripts.metadata_search.id_set"
+
+# Comparison operators for searching the local index
+COMPARISONS = {">=": operator.ge, "<=": operator.le, ">": operator.gt,
+               "<": operator.lt, "=": operator.eq, "!=": operator.ne}
+
+# Number of Image IDs returned per query
+PAGE_SIZE = 10000
+
+# Where the optional local metadata index files are kept
+INDEX_DIR = os.environ.get(
+    "OMERO_METADATA_INDEX_DIR",
+    os.path.join(tempfile.gettempdir(), "omero_metadata_index"))
+
+# The tables of the local index, by the alias of the query they come from,
+# as alias: (table name, columns)
+INDEX_TABLES = {
+    "pixels": ("images", ("imageId", "sizeZ", "sizeC", "sizeT")),
+    "lc": ("channels", ("imageId", "name", "excitationWave")),
+    "ob": ("objectives", ("imageId", "nominalMagnification", "lensNA",
+                          "model")),
+    }
+
+
+# The fields that can be searched on, by the name used in script parameters
+# and 'Or_Groups', as name: (alias, field, type)
+FIELDS = {
+    "Size_Z": ("pixels", "sizeZ", int),
+    "Size_T": ("pixels", "sizeT", int),
+    "Channel_Count": ("pixels", "sizeC", int),
+    "Channel_Name": ("lc", "name", str),
+    "Excitation_Wavelength": ("lc", "excitationWave", int),
+    "Magnification": ("ob", "nominalMagnification", int),
+    "Lens_NA": ("ob", "lensNA", float),
+    "Objective_Model": ("ob", "model", str),
+    }
+
+# Comparison operators, longest first for parsing 'Or_Groups'
+OPERATORS = [">=", "<=", "!=", "=", ">", "<"]
+
+
+def parseGroup(text):
+    """
+    Parses an 'Or_Groups' entry of conditions separated by ';', e.g.
+    "Magnification>=60; Channel_Name=DAPI,GFP", into a list of predicates.
+    A comma separated list of values gives an 'in' predicate, and is only
+    allowed with '='.
+    """
+    predicates = []
+    for condition in text.split(";"):
+        if condition.strip() == "":
+            continue
+        for op in OPERATORS:
+            if op in condition:
+                name, value = [v.strip() for v in condition.split(op, 1)]
+                break
+        else:
+            raise ValueError("No operator in search condition: %s"
+                             % condition)
+        if name not in FIELDS:
+            raise ValueError("Unknown search field: %s" % name)
+        alias, field, fieldType = FIELDS[name]
+        values = [fieldType(v.strip()) for v in value.split(",")]
+        if len(values) > 1 and op != "=":
+            raise ValueError("A list of values needs '=' in search"
+                             " condition: %s" % condition)
+        if len(values) > 1:
+            predicates.append((alias, field, "in", values))
+        else:
+            predicates.append((alias, field, op, values[0]))
+    return predicates
+
+
+def getPredicates(scriptParams):
     """
-    Here we build our hql query and get the results from the queryService
+    Returns the search criteria from the script parameters as a list of
+    (alias, field, operator, value), e.g. ("pixels", "sizeZ", ">=", 5).
+    Predicates on the same alias apply to the same row, e.g. the same
+    channel must have the name and the excitation wavelength.
+    If there are 'Or_Groups', the last predicate is ("or", None, "or",
+    groups) where groups is a list of predicate lists, any of which must
+    match.
     """
 
-    # Script has defaults for some parameters, so we know these are filled
-    minSizeC = scriptParams["Min_Channel_Count"]
-    minSizeZ = scriptParams["Min_Size_Z"]
-    minSizeT = scriptParams["Min_Size_T"]
+    predicates = []
+    for name, (alias, field, fieldType) in sorted(FIELDS.items()):
+        if fieldType is str:
+            continue
+        minValue = scriptParams.get("Min_%s" % name)
+        maxValue = scriptParams.get("Max_%s" % name)
+        # Min sizes default to 1, which every Image has
+        if minValue is not None and not (alias == "pixels" and minValue <= 1):
+            predicates.append((alias, field, ">=", fieldType(minValue)))
+        if maxValue is not None:
+            predicates.append((alias, field, "<=", fieldType(maxValue)))
+
     # For others, we check if specified
-    channelNames = "Channel_Names" in scriptParams and \
-        scriptParams["Channel_Names"] or []
-    nominalMagnification = "Magnification" in scriptParams and \
-        scriptParams["Magnification"] or None
+    channelNames = list(scriptParams.get("Channel_Names", []))
+    excitationWaves = list(scriptParams.get("Excitation_Wavelengths", []))
+    nominalMagnifications = list(scriptParams.get("Magnifications", []))
+    objectiveModels = list(scriptParams.get("Objective_Models", []))
+    # single values are the same as a list of one
+    if "Excitation_Wavelength" in scriptParams:
+        excitationWaves.append(scriptParams["Excitation_Wavelength"])
+    if "Magnification" in scriptParams:
+        nominalMagnifications.append(scriptParams["Magnification"])
+    if "Objective_Model" in scriptParams:
+        objectiveModels.append(scriptParams["Objective_Model"])
     lensNA = "Lens_NA" in scriptParams and scriptParams["Lens_NA"] or None
-    excitationWave = "Excitation_Wavelength" in scriptParams and \
-        scriptParams["Excitation_Wavelength"] or None
-    objectiveModel = "Objective_Model" in scriptParams and \
-        scriptParams["Objective_Model"] or None
 
+    for values, alias, field in [
+            (channelNames, "lc", "name"),
+            (excitationWaves, "lc", "excitationWave"),
+            (nominalMagnifications, "ob", "nominalMagnification"),
+            (objectiveModels, "ob", "model")]:
+        if len(values) == 1:
+            predicates.append((alias, field, "=", values[0]))
+        elif len(values) > 1:
+            predicates.append((alias, field, "in", values))
+    if lensNA is not None:
+        predicates.append(("ob", "lensNA", "=", float(lensNA)))
+
+    orGroups = scriptParams.get("Or_Groups", [])
+    groups = [parseGroup(g) for g in orGroups]
+    groups = [g for g in groups if len(g) > 0]
+    if len(groups) > 0:
+        predicates.append(("or", None, "or", groups))
+    return predicates
+
+
+def compilePredicate(predicate, params, prefix=""):
+    """
+    Compiles a predicate from getPredicates() to an hql condition, adding its
+    values to params.
+    Each 'or' group is compiled to a subquery with its own aliases, so that
+    its predicates don't have to match the same rows as the other criteria,
+    as in the local index.
+
+    @param prefix:  Prefix of the aliases, for the predicates of a group
+    @return:        Tuple of (list of aliases used, condition)
+    """
+    alias, field, op, value = predicate
+    if op == "or":
+        groups = []
+        for g, group in enumerate(value):
+            groupPrefix = "g%s_" % g
+            aliases = []
+            conditions = []
+            for p in group:
+                groupAliases, condition = compilePredicate(
+                    p, params, groupPrefix)
+                aliases.extend(groupAliases)
+                conditions.append(condition)
+            groups.append("i.id in (select %si.id from Image %si %s where %s)"
+                          % (groupPrefix, groupPrefix,
+                             " ".join(getJoins(aliases, groupPrefix)),
+                             " and ".join(conditions)))
+        return [], "(%s)" % " or ".join(groups)
+
+    name = "p%s" % len(params.map)
+    params.add(name, wrap(value))
+    if op == "in":
+        return [alias], "%s%s.%s in (:%s)" % (prefix, alias, field, name)
+    return [alias], "%s%s.%s%s:%s" % (prefix, alias, field, op, name)
+
+
+def getJoins(aliases, prefix=""):
+    """
+    Returns the hql join clauses needed for the aliases, in order, e.g.
+    ["join i.pixels as pixels", "join pixels.channels as c"] for "c".
+
+    @param prefix:  Prefix of all the aliases, including the Image's 'i'
+    """
+    joins = []
+
+    def addJoin(alias):
+        if alias == "i" or alias in joins:
+            return
+        addJoin(JOINS[alias][0])
+        joins.append(alias)
+
+    for alias in aliases:
+        addJoin(alias)
+    return ["join %s%s.%s as %s%s" % (prefix, JOINS[alias][0],
+                                      JOINS[alias][1], prefix, alias)
+            for alias in joins]
+
+
+def buildQuery(clauses):
+    """
+    Builds an hql projection query of distinct Image IDs, with only the joins
+    needed by the clauses.
+    Each clause is (aliases, hql condition). The query ends with an 'i.id >
+    :lastId' condition so that results can be paged by Image ID.
+
+    @param clauses:     List of (aliases, condition) e.g. (["lc"], "lc.name
+                        in (:p0)")
+    @return:            The query string
+    """
+    aliases = [alias for clauseAliases, condition in clauses
+               for alias in clauseAliases]
+    query = " ".join(["select distinct i.id from Image i"] +
+                     getJoins(aliases))
+    conditions = [condition for clauseAliases, condition in clauses]
+    conditions.append("i.id > :lastId")
+    return query + " where " + " and ".join(conditions) + " order by i.id"
+
+
+def iterProjection(conn, query, params, pageSize=PAGE_SIZE):
+    """
+    Yields pages of rows from a projection query whose first column is the
+    Image ID. The query must have an 'i.id > :lastId' condition and be
+    ordered by Image ID, so that each page starts after the last one.
+    """
     qs = conn.getQueryService()
-    params = omero.sys.Parameters()
-    params.map = {}
-    clauses = []
-
-    query = "select i from Image i left outer join i.pixels as pixels"
-
-    if minSizeZ > 1 or minSizeC > 1 or minSizeT > 1:
-        # We have already joined pixels
-        if minSizeZ > 1:
-            params.map["sizeZ"] = rint(minSizeZ)
-            clauses.append("pixels.sizeZ>=:sizeZ")
-        if minSizeC > 1:
-            params.map["sizeC"] = rint(minSizeC)
-            clauses.append("pixels.sizeC>=:sizeC")
-        if minSizeT > 1:
-            params.map["sizeT"] = rint(minSizeT)
-            clauses.append("pixels.sizeT>=:sizeT")
-
-    if len(channelNames) > 0 or excitationWave is not None:
-        query = query + " left outer join pixels.channels as c join" \
-            " c.logicalChannel as lc"
-        if len(channelNames) > 0:
-            params.map["cNames"] = wrap(channelNames)
-            clauses.append("lc.name in (:cNames)")
-        if excitationWave is not None:
-            params.map["exWave"] = wrap(excitationWave)
-            clauses.append("lc.excitationWave=:exWave)")
-
-    if nominalMagnification is not None or lensNA is not None or \
-            objectiveModel is not None:
-        query += " join i.objectiveSettings as objS join objS.objective as ob"
-        if nominalMagnification is not None:
-            params.map["nomMag"] = rint(nominalMagnification)
-            clauses.append("ob.nominalMagnification=:nomMag")
-        if lensNA is not None:
-            params.map["lensNA"] = rdouble(lensNA)
-            clauses.append("ob.lensNA=:lensNA")
-        if objectiveModel is not None:
-            params.map["objectiveModel"] = wrap(objectiveModel)
-            clauses.append("ob.model=:objectiveModel")
-
-    query = query + " where " + " and ".join(clauses)
+    lastId = 0
+    params.page(0, pageSize)
+    while True:
+        params.add("lastId", rlong(lastId))
+        rows = [[unwrapValue(v) for v in row] for row in
+                qs.projection(query, params, conn.SERVICE_OPTS)]
+        if len(rows) == 0:
+            break
+        yield rows
+        if len(rows) < pageSize:
+            break
+        lastId = rows[-1][0]
+
+
+def searchImages(conn, scriptParams, pageSize=PAGE_SIZE):
+    """
+    Here we build our hql query and get the results from the queryService.
+    All the predicates, ranges, lists and 'or' groups are compiled into a
+    single query.
+    Yields lists of Image IDs, one page at a time, so that large searches
+    return results quickly and never hold every result in memory.
+    """
+
+    params = omero.sys.ParametersI()
+    predicates = getPredicates(scriptParams)
+    clauses = [compilePredicate(p, params) for p in predicates]
+
+    query = buildQuery(clauses)
 
     print "Searh parameters map:", unwrap(params.map)
     print query
 
-    imgs = qs.findAllByQuery(query, params)
-    return imgs
+    # Page through the results by Image ID
+    for rows in iterProjection(conn, query, params, pageSize):
+        yield [row[0] for row in rows]
+
+
+def unwrapValue(value):
+    """
+    Unwraps an rtype, also unwrapping units such as Length to their value.
+    """
+    value = unwrap(value)
+    if hasattr(value, "getValue"):
+        value = value.getValue()
+    return value
+
+
+def getIndexPath(conn):
+    """
+    Returns the path of the local index file for the current user and group
+    """
+    ctx = conn.getEventContext()
+    return os.path.join(INDEX_DIR, "index_user%s_group%s.npz"
+                        % (ctx.userId, ctx.groupId))
+
+
+def loadIndex(path):
+    """
+    Loads the local index from the file at path, or returns a new empty
+    index if there is no file (or path is None).
+    The index is a dict of table name: {column name: numpy array} for each
+    table in INDEX_TABLES, plus the 'lastEventId' it is up to date with.
+    """
+    from numpy import array, load
+
+    index = {"lastEventId": 0}
+    for table, columns in INDEX_TABLES.values():
+        index[table] = dict([(c, array([])) for c in columns])
+    if path is not None and os.path.exists(path):
+        data = load(path)
+        index["lastEventId"] = int(data["lastEventId"])
+        for key in data.files:
+            if "." in key:
+                table, column = key.split(".", 1)
+                index[table][column] = data[key]
+    return index
+
+
+def saveIndex(index, path):
+    """ Saves the index as a single numpy .npz file of columns """
+    from numpy import array, savez
+
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    arrays = {"lastEventId": array(index["lastEventId"])}
+    for table, columns in INDEX_TABLES.values():
+        for c in columns:
+            arrays["%s.%s" % (table, c)] = index[table][c]
+    savez(path, **arrays)
+
+
+def updateIndex(conn, index, pageSize=PAGE_SIZE):
+    """
+    Brings the local index up to date with the server. Only the Images
+    updated since the last event the index has seen are fetched, along with
+    their channels and objectives. Deleted Images are dropped by checking
+    the IDs of all Images, which is a cheap query.
+    NB: changes to channels or objectives that don't update their Image are
+    only picked up when the index is rebuilt.
+    """
+    from numpy import array, concatenate, float64, in1d, int64, nan, str_
+
+    # IDs of all the current Images, to drop any that have been deleted
+    params = omero.sys.ParametersI()
+    query = "select i.id from Image i where i.id > :lastId order by i.id"
+    currentIds = [row[0] for rows in
+                  iterProjection(conn, query, params, pageSize)
+                  for row in rows]
+
+    # Find the Images updated since the last update...
+    params = omero.sys.ParametersI()
+    params.add("since", rlong(index["lastEventId"]))
+    query = "select i.id, i.details.updateEvent.id, pixels.sizeZ," \
+        " pixels.sizeC, pixels.sizeT from Image i" \
+        " left outer join i.pixels as pixels" \
+        " where i.details.updateEvent.id > :since and i.id > :lastId" \
+        " order by i.id"
+    updated = {"images": [], "channels": [], "objectives": []}
+    lastEventId = index["lastEventId"]
+    qs = conn.getQueryService()
+    for rows in iterProjection(conn, query, params, pageSize):
+        ids = [row[0] for row in rows]
+        lastEventId = max([lastEventId] + [row[1] for row in rows])
+        updated["images"].extend([[row[0]] + row[2:] for row in rows])
+
+        # ...and their channels and objectives
+        idParams = omero.sys.ParametersI()
+        idParams.addIds(ids)
+        query = "select pixels.image.id, lc.name, lc.excitationWave" \
+            " from Pixels pixels join pixels.channels as c" \
+            " join c.logicalChannel as lc where pixels.image.id in (:ids)"
+        updated["channels"].extend(
+            [[unwrapValue(v) for v in row] for row in
+             qs.projection(query, idParams, conn.SERVICE_OPTS)])
+        query = "select i.id, ob.nominalMagnification, ob.lensNA, ob.model" \
+            " from Image i join i.objectiveSettings as objS" \
+            " join objS.objective as ob where i.id in (:ids)"
+        updated["objectives"].extend(
+            [[unwrapValue(v) for v in row] for row in
+             qs.projection(query, idParams, conn.SERVICE_OPTS)])
+
+    updatedIds = array([row[0] for row in updated["images"]], dtype=int64)
+    for table, columns in INDEX_TABLES.values():
+        # Drop rows of deleted or updated Images, then add the updated rows
+        old = index[table]
+        keep = in1d(old["imageId"], currentIds) & \
+            ~in1d(old["imageId"], updatedIds)
+        rows = updated[table]
+        for i, c in enumerate(columns):
+            new = [row[i] for row in rows]
+            if c == "imageId":
+                new = array(new, dtype=int64)
+            elif c in ("name", "model"):
+                new = array(["" if v is None else v for v in new], dtype=str_)
+            else:
+                new = array([nan if v is None else v for v in new],
+                            dtype=float64)
+            if len(old[c]) == 0:
+                old[c] = new
+            else:
+                old[c] = concatenate([old[c][keep], new])
+
+    index["lastEventId"] = lastEventId
+    print "Index updated: %s Images changed, %s Images in index" \
+        % (len(updatedIds), len(index["images"]["imageId"]))
+    return index
+
+
+def evaluatePredicates(index, predicates):
+    """
+    Returns a boolean mask (bitmap) over the Images of the local index for
+    the predicates, combining a mask for each predicate. Predicates on
+    channels or objectives are combined on their rows before being mapped to
+    Images, to match the database query.
+    """
+    from numpy import in1d, ones, zeros
+
+    imageIds = index["images"]["imageId"]
+    result = ones(len(imageIds), dtype=bool)
+    byAlias = {}
+    for alias, field, op, value in predicates:
+        if op == "or":
+            anyGroup = zeros(len(imageIds), dtype=bool)
+            for group in value:
+                anyGroup |= evaluatePredicates(index, group)
+            result &= anyGroup
+        else:
+            byAlias.setdefault(alias, []).append((field, op, value))
+
+    for alias, aliasPredicates in byAlias.items():
+        table = index[INDEX_TABLES[alias][0]]
+        mask = ones(len(table["imageId"]), dtype=bool)
+        for field, op, value in aliasPredicates:
+            column = table[field]
+            if op == "in":
+                mask &= in1d(column, value)
+            else:
+                mask &= COMPARISONS[op](column, value)
+                if op == "!=" and column.dtype.kind == "f":
+                    mask &= column == column    # like NULL, NaN never matches
+        if alias == "pixels":
+            result &= mask
+        else:
+            result &= in1d(imageIds, table["imageId"][mask])
+    return result
+
+
+def searchIndex(index, scriptParams, pageSize=PAGE_SIZE):
+    """
+    Does the same search as searchImages() using the local index.
+    Yields lists of Image IDs, one page at a time, like searchImages().
+    """
+    from numpy import int64
+
+    imageIds = index["images"]["imageId"]
+    result = evaluatePredicates(index, getPredicates(scriptParams))
+
+    ids = sorted(set(imageIds[result].astype(int64).tolist()))
+    print "Index search found %s Images" % len(ids)
+    for i in range(0, len(ids), pageSize):
+        yield ids[i:i + pageSize]
+
+
+def encodeIdSet(ids):
+    """
+    Returns the IDs as a sorted, delta-encoded set: a tuple of (first ID,
+    array of the gaps between IDs). The gaps use the smallest unsigned
+    integer type that holds the largest gap.
+    """
+    from numpy import array, asarray, diff, iinfo, int64, uint8, uint16, \
+        uint32, uint64, unique
+
+    ids = unique(asarray(ids, dtype=int64))
+    if len(ids) == 0:
+        return array([], dtype=int64), array([], dtype=uint8)
+    deltas = diff(ids)
+    for dtype in (uint8, uint16, uint32):
+        if len(deltas) == 0 or deltas.max() <= iinfo(dtype).max:
+            return ids[:1], deltas.astype(dtype)
+    return ids[:1], deltas.astype(uint64)
+
+
+def decodeIdSet(first, deltas):
+    """ Returns the sorted array of IDs from encodeIdSet() """
+    from numpy import concatenate, cumsum, int64
+
+    return cumsum(concatenate([first, deltas]), dtype=int64)
+
+
+def saveIdSet(conn, ids, name, description=None):
+    """
+    Saves the Image IDs as a compressed, delta-encoded ID set in a new File
+    Annotation, which can be combined with other saved searches later.
+
+    @return:    The FileAnnotationWrapper
+    """
+    from numpy import savez_compressed
+
+    path = os.path.join(tempfile.gettempdir(), name)
+    first, deltas = encodeIdSet(ids)
+    savez_compressed(path, first=first, deltas=deltas)
+    try:
+        fileAnn = conn.createFileAnnfromLocalFile(
+            path, mimetype="application/octet-stream", ns=ID_SET_NS,
+            desc=description)
+    finally:
+        os.remove(path)
+    return fileAnn
 
 
-def tagImages(conn, imageIds, searchDesc=None):
+def loadIdSet(conn, fileAnnId):
     """
-    Creates a new 'search results' Tag with timestamp and links to the images
+    Returns the sorted array of Image IDs saved by saveIdSet() in the File
+    Annotation.
+    """
+    from numpy import load
+
+    fileAnn = conn.getObject("FileAnnotation", fileAnnId)
+    if fileAnn is None or fileAnn.getNs() != ID_SET_NS:
+        raise ValueError("File Annotation %s is not a saved search ID set"
+                         % fileAnnId)
+    data = "".join(fileAnn.getFileInChunks())
+    data = load(StringIO(data))
+    return decodeIdSet(data["first"], data["deltas"])
+
+
+def combineIdSets(ids, others, operation):
+    """
+    Combines the sorted array of IDs with each of the other sorted ID arrays
+    in turn, using the set operation: 'Intersection', 'Union' or
+    'Difference' (the IDs not in any of the others).
+    """
+    from numpy import intersect1d, setdiff1d, union1d
+
+    for other in others:
+        if ids is None:
+            ids = other
+        elif operation == "Intersection":
+            ids = intersect1d(ids, other, assume_unique=True)
+        elif operation == "Union":
+            ids = union1d(ids, other)
+        else:
+            ids = setdiff1d(ids, other, assume_unique=True)
+    return ids
+
+
+def tagImages(conn, imageIdPages, searchDesc=None, batchSize=1000):
+    """
+    Creates a new 'search results' Tag with timestamp and links to the images.
+    The links are saved in batches of batchSize as the pages of Image IDs
+    arrive, without returning the saved objects, so that huge results use
+    bounded memory and small transactions.
+    The Tag is only created if there are some images.
+
+    @param imageIdPages:    Iterable of lists of Image IDs
+    @return:                Tuple of (tagText, number of images tagged)
     """
 
     now = datetime.now()
     tagText = "Search Results %s %s:%s:%s" \
         % (now.date(), now.hour, now.minute, now.second)
-    tag = omero.model.TagAnnotationI()
-    tag.setTextValue(wrap(tagText))
-    if searchDesc is not None:
-        tag.setDescription(wrap(searchDesc))
 
-    newLinks = []
-    for iid in imageIds:
-        link = omero.model.ImageAnnotationLinkI()
-        link.setParent(omero.model.ImageI(iid, False))
-        link.child = tag
-        newLinks.append(link)
-
-    conn.getUpdateService().saveAndReturnArray(newLinks)
-    return tagText
+    updateService = conn.getUpdateService()
+    tag = None
+    count = 0
+    for imageIds in imageIdPages:
+        if tag is None:
+            tag = omero.model.TagAnnotationI()
+            tag.setTextValue(wrap(tagText))
+            if searchDesc is not None:
+                tag.setDescription(wrap(searchDesc))
+            tag = updateService.saveAndReturnObject(tag)
+            tag = omero.model.TagAnnotationI(tag.getId().getValue(), False)
+
+        for i in range(0, len(imageIds), batchSize):
+            newLinks = []
+            for iid in imageIds[i:i + batchSize]:
+                link = omero.model.ImageAnnotationLinkI()
+                link.setParent(omero.model.ImageI(iid, False))
+                link.child = tag
+                newLinks.append(link)
+            updateService.saveArray(newLinks)
+            count += len(newLinks)
+        print "Tagged %s Images" % count
+    return tagText, count
 
 
 def metadataSearch(conn, scriptParams):
@@ -135,16 +614,71 @@ def metadataSearch(conn, scriptParams):
 
     searchParams = ["%s: %s" % (k, v) for k, v in scriptParams.items()]
     searchDesc = "\n".join(searchParams)
-
-    # Do the search...
-    imageResults = searchImages(conn, scriptParams)
-    imgIds = [i.id.val for i in imageResults]
-    imgIds = list(set(imgIds))  # remove any duplicates
-
-    print "Result Image IDs: ", imgIds
-    tagText = tagImages(conn, imgIds, searchDesc)
-
-    return "%s Images found. Tagged with '%s'" % (len(imgIds), tagText)
+    batchSize = scriptParams.get("Batch_Size", 1000)
+    saveAs = scriptParams.get("Save_Results_As", "Tag")
+    combineWith = scriptParams.get("Combine_With", [])
+    operation = scriptParams.get("Set_Operation", "Intersection")
+
+    # Without criteria the search would match every Image
+    if not scriptParams.get("Saved_Sets_Only", False) and \
+            len(getPredicates(scriptParams)) == 0:
+        return "No search criteria"
+
+    # Do the search, tagging each page of results as it arrives
+    if scriptParams.get("Saved_Sets_Only", False):
+        imageIdPages = []
+    elif scriptParams.get("Use_Local_Index", False):
+        indexPath = getIndexPath(conn)
+        if scriptParams.get("Rebuild_Index", False):
+            index = loadIndex(None)
+        else:
+            index = loadIndex(indexPath)
+        if scriptParams.get("Update_Index", True):
+            index = updateIndex(conn, index)
+            saveIndex(index, indexPath)
+        imageIdPages = searchIndex(index, scriptParams)
+    else:
+        imageIdPages = searchImages(conn, scriptParams)
+
+    # If we need all the results, we keep them as a sorted ID array
+    if saveAs != "Tag" or len(combineWith) > 0:
+        from numpy import array, int64, unique
+        ids = None
+        if not scriptParams.get("Saved_Sets_Only", False):
+            ids = unique(array([i for page in imageIdPages for i in page],
+                               dtype=int64))
+        others = [loadIdSet(conn, fid) for fid in combineWith]
+        ids = combineIdSets(ids, others, operation)
+        if ids is None:
+            return "No search or saved searches to combine"
+        imageIdPages = (ids[i:i + PAGE_SIZE].tolist()
+                        for i in range(0, len(ids), PAGE_SIZE))
+
+    messages = []
+    if saveAs == "Tag":
+        tagText, count = tagImages(conn, imageIdPages, searchDesc, batchSize)
+        if count > 0:
+            messages.append("Tagged with '%s'" % tagText)
+    else:
+        count = len(ids)
+        if saveAs == "Tag and ID Set" and count > 0:
+            tagText, count = tagImages(conn, imageIdPages, searchDesc,
+                                       batchSize)
+            messages.append("Tagged with '%s'" % tagText)
+        now = datetime.now()
+        name = "Search Results %s %02d-%02d-%02d.npz" \
+            % (now.date(), now.hour, now.minute, now.second)
+        fileAnn = saveIdSet(conn, ids, name, searchDesc)
+        messages.append("Saved as ID set: File Annotation %s"
+                        % fileAnn.getId())
+
+    if count == 0 and len(messages) == 0:
+        return "No Images found"
+    return "%s Images found. %s" % (count, ". ".join(messages))
+
+
+# The function doing the work of the script, also called by run_batch
+WORK_FUNCTION = metadataSearch
 
 
 def runScript():
@@ -153,6 +687,11 @@ def runScript():
     scripting service, passing the required parameters.
     """
 
+    saveOptions = [rstring('Tag'), rstring('ID Set'),
+                   rstring('Tag and ID Set')]
+    setOperations = [rstring('Intersection'), rstring('Union'),
+                     rstring('Difference')]
+
     client = scripts.client(
         'Metadata_Search.py',
         """This script searches for Images, using database queries generated \
@@ -162,15 +701,28 @@ from a number of parameters.""",
             "Min_Size_Z", grouping="1", default=1, min=1,
             description="Find images with this number of Z-planes or more"),
 
+        scripts.Int(
+            "Max_Size_Z", grouping="1.1", min=1,
+            description="Find images with this number of Z-planes or less"),
+
         scripts.Int(
             "Min_Size_T", grouping="2", default=1, min=1,
             description="Find images with this number of time-points or"
             " more"),
 
+        scripts.Int(
+            "Max_Size_T", grouping="2.1", min=1,
+            description="Find images with this number of time-points or"
+            " less"),
+
         scripts.Int(
             "Min_Channel_Count", grouping="3", default=1, min=1,
             description="Find images with this number of channels or more"),
 
+        scripts.Int(
+            "Max_Channel_Count", grouping="3.1", min=1,
+            description="Find images with this number of channels or less"),
+
         scripts.List(
             "Channel_Names", grouping="4",
             description="Find images containing channels with these names"),
@@ -180,6 +732,21 @@ from a number of parameters.""",
             description="Find images with channels of this excitation"
             " wavelength"),
 
+        scripts.List(
+            "Excitation_Wavelengths", grouping="4.2",
+            description="Find images with channels of any of these excitation"
+            " wavelengths").ofType(rint(0)),
+
+        scripts.Int(
+            "Min_Excitation_Wavelength", grouping="4.3",
+            description="Find images with channels of this excitation"
+            " wavelength or more"),
+
+        scripts.Int(
+            "Max_Excitation_Wavelength", grouping="4.4",
+            description="Find images with channels of this excitation"
+            " wavelength or less"),
+
         scripts.String(
             "Objective_Model", grouping="5",
             description="Save individual channels as separate images"),
@@ -192,6 +759,84 @@ from a number of parameters.""",
             "Lens_NA", grouping="5.2",
             description="Find images with this Lens NA value"),
 
+        scripts.List(
+            "Objective_Models", grouping="5.3",
+            description="Find images with any of these Objective Models"),
+
+        scripts.List(
+            "Magnifications", grouping="5.4",
+            description="Find images with any of these Nominal"
+            " Magnifications").ofType(rint(0)),
+
+        scripts.Int(
+            "Min_Magnification", grouping="5.5",
+            description="Find images with this Nominal Magnification or"
+            " more"),
+
+        scripts.Int(
+            "Max_Magnification", grouping="5.6",
+            description="Find images with this Nominal Magnification or"
+            " less"),
+
+        scripts.Float(
+            "Min_Lens_NA", grouping="5.7",
+            description="Find images with this Lens NA value or more"),
+
+        scripts.Float(
+            "Max_Lens_NA", grouping="5.8",
+            description="Find images with this Lens NA value or less"),
+
+        scripts.List(
+            "Or_Groups", grouping="5.9",
+            description="Find images matching any of these groups of"
+            " conditions, as well as the criteria above. Each group is"
+            " conditions separated by ';' e.g. 'Magnification>=60;"
+            " Channel_Name=DAPI,GFP', where a list of values needs '='."
+            " Fields are Size_Z, Size_T,"
+            " Channel_Count, Channel_Name, Excitation_Wavelength,"
+            " Magnification, Lens_NA and Objective_Model"),
+
+        scripts.Int(
+            "Batch_Size", grouping="6", default=1000, min=1,
+            description="Number of Images to tag in each call"),
+
+        scripts.Bool(
+            "Use_Local_Index", grouping="7", default=False,
+            description="Search a local index of Image metadata, kept on the"
+            " script server, instead of querying the database"),
+
+        scripts.Bool(
+            "Update_Index", grouping="7.1", default=True,
+            description="Update the local index with Images changed since"
+            " the last update before searching"),
+
+        scripts.Bool(
+            "Rebuild_Index", grouping="7.2", default=False,
+            description="Rebuild the local index from scratch"),
+
+        scripts.String(
+            "Save_Results_As", grouping="8", values=saveOptions,
+            default="Tag",
+            description="Tag the Images found and/or save their IDs as a"
+            " compressed ID set in a File Annotation, which can be combined"
+            " with other saved searches"),
+
+        scripts.List(
+            "Combine_With", grouping="9",
+            description="IDs of File Annotations of saved ID sets to combine"
+            " with the search results").ofType(rlong(0)),
+
+        scripts.String(
+            "Set_Operation", grouping="9.1", values=setOperations,
+            default="Intersection",
+            description="How to combine the results with the saved ID sets."
+            " Difference gives the Images not in any of the saved sets"),
+
+        scripts.Bool(
+            "Saved_Sets_Only", grouping="9.2", default=False,
+            description="Don't search. Only combine the saved ID sets,"
+            " starting with the first"),
+
         version="4.4.9",
         authors=["William Moore", "OME Team"],
         institutions=["University of Dundee"],
@@ -199,16 +844,18 @@ from a number of parameters.""",
     )
 
     try:
+        # process the list of args above, fetching each input once
         scriptParams = {}
-
-        conn = BlitzGateway(client_obj=client)
-
-        # process the list of args above.
         for key in client.getInputKeys():
-            if client.getInput(key):
-                scriptParams[key] = client.getInput(key, unwrap=True)
+            value = client.getInput(key)
+            if value:
+                scriptParams[key] = unwrap(value)
         print scriptParams
 
+        # wrap client to use the Blitz Gateway
+        from omero.gateway import BlitzGateway
+        conn = BlitzGateway(client_obj=client)
+
         # call the main script - returns a message
         message = metadataSearch(conn, scriptParams)
 
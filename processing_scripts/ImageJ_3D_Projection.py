@@ -20,19 +20,36 @@
 
 ------------------------------------------------------------------------------
 
-This script uses ImageJ to process an image Z-stack from OMERO,
-generating a series of 3D projections.
+This script processes an image Z-stack from OMERO, generating a series of
+3D projections.
 These are then uploaded to OMERO as a new image stack.
-NB: Need to have ImageJ installed on the server and the IMAGEJPATH below
-needs to be updated to point at the jar.
+By default the projections are done in-process with numpy. They can also be
+done with ImageJ, in which case ImageJ needs to be installed on the server
+and the IMAGEJPATH below needs to be updated to point at the jar.
 """
 
-from omero.gateway import BlitzGateway
-from omero.rtypes import rstring, rlong, robject
+import omero
+from omero.rtypes import rstring, rlong, rint, robject, unwrap
 import omero.scripts as scripts
 import os
-import Image
-from numpy import zeros, int32, asarray
+import math
+import time
+import shutil
+import subprocess
+import tempfile
+import hashlib
+import json
+import sys
+import threading
+import Queue
+import multiprocessing
+from collections import deque
+from functools import partial
+from itertools import tee
+from numpy import zeros, asarray, mgrid, around, floor, intp, nonzero, \
+    unique, ones, float64, int32, add, maximum, diff, append, where, memmap, \
+    load, frombuffer
+from numpy.lib.format import open_memmap
 from cStringIO import StringIO
 
 
@@ -40,6 +57,99 @@ from cStringIO import StringIO
 IMAGEJPATH = "/Applications/ImageJ/ImageJ.app/Contents/Resources/Java/ij.jar"
 # Path to ij.jar
 
+# Seconds an ImageJ job may run before it is killed, the number of times a
+# job is retried if ImageJ exits, and seconds between checks on a job
+IMAGEJ_JOB_TIMEOUT = 300
+IMAGEJ_JOB_RETRIES = 1
+IMAGEJ_POLL_INTERVAL = 0.05
+
+# The macro run by the ImageJ worker. It runs the jobs spool/job_<n>.txt in
+# order from the first job number, writing spool/job_<n>.done after each.
+# A job is the arguments for a rotation projection of a staged stack,
+# separated by "*", or "quit".
+IMAGEJ_WORKER_MACRO = """
+args=split(getArgument(),"*");
+spool=args[0];
+n=parseInt(args[1]);
+setBatchMode(true);
+while (true) {
+    job=spool+"job_"+n+".txt";
+    if (File.exists(job)) {
+        a=split(File.openAsString(job),"*");
+        if (a[0]=="quit") {
+            exit;
+        }
+        run("Raw...", "open=["+a[0]+"] image=["+a[2]+"] width="+a[3]+\
+" height="+a[4]+" offset="+a[5]+" number="+a[6]+" gap=0 little-endian");
+        run("3D Project...", "projection=["+a[7]+"] axis="+a[8]+\
+"-Axis slice=1 initial=0 total="+a[9]+" rotation="+a[10]+" lower="+a[11]+\
+" upper="+a[12]+" opacity=0 surface=100 interior=50");
+        saveAs("Raw Data", a[1]);
+        File.saveString(""+getWidth()+" "+getHeight()+" "+nSlices+" "+\
+bitDepth(), a[1]+".txt");
+        while (nImages>0) {
+            selectImage(nImages);
+            close();
+        }
+        File.saveString("done", spool+"job_"+n+".done");
+        n++;
+    } else {
+        wait(50);
+    }
+}
+"""
+
+# Version of the projections this script makes, part of the cache key, so
+# should change whenever the results would change
+SCRIPT_VERSION = "2.0"
+
+# Where the cache of projections made by the script is kept
+CACHE_DIR = os.environ.get(
+    "OMERO_PROJECTION_CACHE_DIR",
+    os.path.join(tempfile.gettempdir(), "omero_projection_cache"))
+
+# Number of stacks to fetch ahead of the one being projected
+PREFETCH_STACKS = 1
+
+# Max number of voxels the numpy engine gathers at once, to bound memory
+MAX_BLOCK_SIZE = 2 ** 24
+
+# Projection methods, named as in the ImageJ '3D Project...' command
+PROJECTION_METHODS = ["Brightest Point", "Mean Value"]
+
+# numpy types of the OMERO pixel types we can read directly
+PIXEL_TYPES = {
+    'int8': 'int8',
+    'uint8': 'uint8',
+    'int16': 'int16',
+    'uint16': 'uint16',
+    'int32': 'int32',
+    'uint32': 'uint32',
+    'float': 'float32',
+    'double': 'float64',
+    }
+
+# ImageJ 'Raw...' import types for the pixel types of staged stacks
+IMAGEJ_RAW_TYPES = {
+    'uint8': "8-bit",
+    'int16': "16-bit Signed",
+    'uint16': "16-bit Unsigned",
+    'int32': "32-bit Signed",
+    'uint32': "32-bit Unsigned",
+    'float': "32-bit Real",
+    'float32': "32-bit Real",
+    'double': "64-bit Real",
+    'float64': "64-bit Real",
+    }
+
+# ImageJ saves raw data big-endian, as bitDepth: (dtype, channels)
+IMAGEJ_OUTPUT_TYPES = {
+    8: ('uint8', 1),
+    16: ('>u2', 1),
+    24: ('uint8', 3),
+    32: ('>f4', 1),
+    }
+
 
 def get_rects_from_rois(conn, imageId):
     """
@@ -70,21 +180,18 @@ def get_rects_from_rois(conn, imageId):
     return rects
 
 
-def download_rendered_planes(image, tiff_stack_dir, region=None):
+def get_rendered_planes(image, region=None, theT=0):
     """
-    Download the specified image as a Z-stack of 'rendered' RGB tiffs to local
-    directory.
-    NB: The pixel values in the downloaded tiff are NOT the raw data as in
-    OMERO.
+    Returns a generator of the rendered Z-planes of the image at theT, as
+    PIL RGB Images.
 
     @param image:               BlitzGateway imageWrapper
-    @param tiff_stack_dir:      Path to directory we want to put out images in
-    @param region:              Tuple of (x, y, width, height) if we want a
-                                region of the image
+    @param region:              Tuple of (x, y, width, height) in whole
+                                pixels if we want a region of the image
+    @param theT:                Index of the timepoint
     """
 
     sizeZ = image.getSizeZ()
-    theT = 0
 
     # getPlane() will either return us the region, OR the whole plane.
     if region is not None:
@@ -92,8 +199,10 @@ def download_rendered_planes(image, tiff_stack_dir, region=None):
 
         def getPlane(z, t):
             print "Getting region", x, y, w, h
-            rv = image.renderJpegRegion(z, t, x, y, w, h)   # returns jpeg data
+            # returns jpeg data, at the best quality
+            rv = image.renderJpegRegion(z, t, x, y, w, h, compression=1.0)
             if rv is not None:
+                import Image
                 i = StringIO(rv)
                 return Image.open(i)
     else:
@@ -101,172 +210,1139 @@ def download_rendered_planes(image, tiff_stack_dir, region=None):
             return image.renderImage(z, t)      # returns PIL Image
 
     for z in range(sizeZ):
-        img_path = os.path.join(tiff_stack_dir, "plane_%02d.tiff" % z)
-        plane = getPlane(z, theT)   # get Plane (or region)
-        plane.save(img_path)
+        yield getPlane(z, theT)   # get Plane (or region)
 
 
-def download_raw_planes(image, tiff_stack_dir, cIndex, region=None):
+def get_raw_planes(image, cIndex, region=None, theT=0):
     """
-    Download the specified image as a Z-stack of 'raw' tiffs to local
-    directory.
-    The pixel type and pixel values of the tiffs will be limited to int32
+    Returns a generator of the raw Z-planes of one channel of the image at
+    theT, as numpy 2D arrays.
 
     @param image:               BlitzGateway imageWrapper
-    @param tiff_stack_dir:      Path to directory we want to put out images in
-    @param region:              Tuple of (x, y, width, height) if we want a
-                                region of the image
+    @param cIndex:              Index of the channel
+    @param region:              Tuple of (x, y, width, height) in whole
+                                pixels if we want a region of the image
+    @param theT:                Index of the timepoint
     """
 
     sizeZ = image.getSizeZ()
-    theT = 0
     theC = cIndex
 
-    def numpyToImage(plane):
-        """
-        Converts the numpy plane to a PIL Image, scaling to cMinMax (minVal,
-        maxVal) and changing data type if needed.
-        Need plane dtype to be uint8 (or int8) for conversion to tiff by PIL
-        """
-        if plane.dtype.name not in ('uint8', 'int8'):
-            convArray = zeros(plane.shape, dtype=int32)
-            # int32 is handled by PIL (not uint32 etc). TODO: support floats
-            convArray += plane
-            return Image.fromarray(convArray)
-        return Image.fromarray(plane)
-
     # We use getTiles() or getPlanes() to provide numpy 2D arrays for each
     # image plane
     if region is not None:
         zctTileList = [(z, theC, theT, region) for z in range(sizeZ)]
-        planes = image.getPrimaryPixels().getTiles(zctTileList)
+        return image.getPrimaryPixels().getTiles(zctTileList)
         # A generator (not all planes in hand)
     else:
         zctList = [(z, theC, theT) for z in range(sizeZ)]
-        planes = image.getPrimaryPixels().getPlanes(zctList)
+        return image.getPrimaryPixels().getPlanes(zctList)
         # A generator (not all planes in hand)
 
+
+def read_raw_planes(image, cIndex, region, out, theT=0):
+    """
+    Reads the raw Z-planes of one channel of the image at theT straight into
+    the preallocated (Z, Y, X) array out, e.g. a memmap. The big-endian bytes
+    from the raw pixels store are converted as they are copied into out, so
+    no array is allocated per plane and the pixel type is kept (unless out
+    has another type).
+
+    @param image:               BlitzGateway imageWrapper
+    @param cIndex:              Index of the channel
+    @param region:              Tuple of (x, y, width, height) in whole
+                                pixels if we want a region of the image
+    @param out:                 numpy array to fill
+    @param theT:                Index of the timepoint
+    """
+
+    theC = cIndex
+    pixels = image.getPrimaryPixels()
+    pixelsType = PIXEL_TYPES[image.getPixelsType()]
+    store = image._conn.c.sf.createRawPixelsStore()
+    try:
+        store.setPixelsId(pixels.getId(), True, image._conn.SERVICE_OPTS)
+        for z in range(out.shape[0]):
+            if region is not None:
+                x, y, w, h = region
+                data = store.getTile(z, theC, theT, x, y, w, h)
+            else:
+                data = store.getPlane(z, theC, theT)
+            out[z] = frombuffer(data, dtype=pixelsType).newbyteorder(
+                '>').reshape(out.shape[1:])
+    finally:
+        store.close()
+
+
+def stage_zstack(image, path, useRawData=False, cIndex=0, region=None,
+                 dtype=None, theT=0):
+    """
+    Writes the Z-stack of the image at theT into a single .npy file at path,
+    one plane at a time, and returns it as a numpy memmap.
+    The stack is (Z, Y, X) for raw data of one channel or (Z, Y, X, 3) for
+    rendered RGB data. Planes are never encoded as image files, so the
+    processing and upload steps can read them straight from the memmap.
+
+    @param image:               BlitzGateway imageWrapper
+    @param path:                Path of the .npy scratch file
+    @param useRawData:          If True, use raw pixels, else rendered RGB
+    @param cIndex:              Index of the channel for raw data
+    @param region:              Tuple of (x, y, width, height) in whole
+                                pixels if we want a region of the image
+    @param dtype:               Convert raw planes to this type if not None
+    @param theT:                Index of the timepoint
+    """
+
+    if useRawData and image.getPixelsType() in PIXEL_TYPES:
+        # Allocate the stack first and read the planes into it
+        if region is not None:
+            shape = (image.getSizeZ(), region[3], region[2])
+        else:
+            shape = (image.getSizeZ(), image.getSizeY(), image.getSizeX())
+        stack = open_memmap(
+            path, mode='w+', shape=shape,
+            dtype=dtype or PIXEL_TYPES[image.getPixelsType()])
+        read_raw_planes(image, cIndex, region, stack, theT)
+        stack.flush()
+        return stack
+
+    if useRawData:
+        planes = get_raw_planes(image, cIndex, region, theT)
+    else:
+        planes = (asarray(p.convert("RGB"))
+                  for p in get_rendered_planes(image, region, theT))
+
+    stack = None
     for z, plane in enumerate(planes):
-        i = numpyToImage(plane)
-        img_path = os.path.join(tiff_stack_dir, "plane_%02d.tiff" % z)
-        i.save(img_path)
+        if stack is None:
+            stack = open_memmap(
+                path, mode='w+', dtype=dtype or plane.dtype,
+                shape=(image.getSizeZ(),) + plane.shape)
+        stack[z] = plane
+    stack.flush()
+    return stack
+
+
+def get_projection_count(angle_step=10, total_rotation=360):
+    """ Returns the number of frames in a rotation projection """
+    return max(int(total_rotation // angle_step), 1)
+
+
+def rotation_projection(stack, axis="Y", angle_step=10, total_rotation=360,
+                        method="Brightest Point", lower=None, upper=None,
+                        max_block=MAX_BLOCK_SIZE):
+    """
+    Generates the frames of a rotating 3D projection of a Z-stack in numpy,
+    like the ImageJ '3D Project...' command with interpolation off and a
+    slice spacing of 1 pixel.
+
+    For each angle, the (x, z) sample points along every line of sight are
+    computed once and the whole stack is gathered in one indexing operation
+    (in blocks of rows to bound memory), then reduced along each line of
+    sight with the max (Brightest Point) or mean (Mean Value).
+
+    @param stack:           numpy array (Z, Y, X)
+    @param axis:            'Y' or 'X', the axis of rotation
+    @param angle_step:      Degrees between frames
+    @param total_rotation:  Degrees of rotation
+    @param method:          'Brightest Point' or 'Mean Value'
+    @param lower:           Ignore voxels below this value (transparency)
+    @param upper:           Ignore voxels above this value
+    @param max_block:       Max number of voxels to gather at once
+    @return:                Generator of 2D numpy frames. For the Y axis
+                            these are (Y, W) where W is the diagonal of the
+                            X-Z plane; for the X axis (W, X)
+    """
+    if axis == "X":
+        # Rotating about X is rotating the transposed stack about Y
+        for frame in rotation_projection(
+                stack.transpose(0, 2, 1), "Y", angle_step, total_rotation,
+                method, lower, upper, max_block):
+            yield frame.T
+        return
+
+    size_z, size_y, size_x = stack.shape
+    # The frame width shares its parity with X and the depth of the line of
+    # sight with Z, so that at 0 degrees the sample points fall on whole
+    # voxels and the centre columns are exactly the max (or mean) over Z
+    width = int(math.ceil(math.hypot(size_x, size_z)))
+    width += (width - size_x) % 2
+    depth = width + (width - size_z) % 2
+    # position across the frame (u) and along the line of sight (t)
+    u, t = mgrid[0:width, 0:depth].astype(float64)
+    u -= (width - 1) / 2.0
+    t -= (depth - 1) / 2.0
+    block_y = max(1, min(size_y, max_block // max(size_x * size_z, 1)))
+
+    for i in range(get_projection_count(angle_step, total_rotation)):
+        angle = math.radians(i * angle_step)
+        # rounded, so that e.g. cos(90) is 0 and not 6e-17
+        cos = round(math.cos(angle), 12)
+        sin = round(math.sin(angle), 12)
+        # round halves up, not to even (as around() does), so that no two
+        # neighbouring columns or slices land on the same voxel
+        x = floor((size_x - 1) / 2.0 + u * cos + t * sin + 0.5).astype(intp)
+        z = floor((size_z - 1) / 2.0 - u * sin + t * cos + 0.5).astype(intp)
+        inside = (x >= 0) & (x < size_x) & (z >= 0) & (z < size_z)
+        # sample points ordered by frame column, so we can reduce each
+        # column with reduceat over contiguous segments
+        cols, depth = nonzero(inside)
+        x = x[cols, depth]
+        z = z[cols, depth]
+        used_cols, starts = unique(cols, return_index=True)
+
+        if method == "Mean Value":
+            frame = zeros((size_y, width), dtype=float64)
+        else:
+            frame = zeros((size_y, width), dtype=stack.dtype)
+        for y in range(0, size_y, block_y):
+            # (n samples, rows in block)
+            values = stack[z, y:y + block_y, x]
+            if len(values) == 0:
+                continue
+            mask = None
+            if lower is not None or upper is not None:
+                mask = ones(values.shape, dtype=bool)
+                if lower is not None:
+                    mask &= values >= lower
+                if upper is not None:
+                    mask &= values <= upper
+            if method == "Mean Value":
+                values = values.astype(float64)
+                if mask is not None:
+                    values *= mask
+                    counts = add.reduceat(mask.astype(intp), starts, axis=0)
+                else:
+                    counts = diff(append(starts, len(values)))[:, None]
+                totals = add.reduceat(values, starts, axis=0)
+                frame[y:y + block_y, used_cols] = \
+                    (totals / maximum(counts, 1)).T
+            else:
+                if mask is not None:
+                    values = where(mask, values, 0).astype(stack.dtype)
+                frame[y:y + block_y, used_cols] = \
+                    maximum.reduceat(values, starts, axis=0).T
+        if method == "Mean Value":
+            if stack.dtype.kind in "iu":
+                frame = around(frame)
+            frame = frame.astype(stack.dtype)
+        yield frame
+
+
+def project_stack(stack, axis="Y", angle_step=10, total_rotation=360,
+                  method="Brightest Point"):
+    """
+    Generates the rotation projection of a Z-stack from get_zstack(), one
+    frame at a time. Each frame is a list of 2D planes, one per channel.
+    """
+
+    if stack.ndim == 3:
+        channels = [stack]
+    else:
+        channels = [stack[..., c] for c in range(stack.shape[-1])]
+    # The ImageJ macro treats 0 as transparent for 8-bit data
+    lower = stack.dtype.name == 'uint8' and 1 or None
+    projections = [rotation_projection(c, axis, angle_step, total_rotation,
+                                       method, lower=lower)
+                   for c in channels]
+    for i in range(get_projection_count(angle_step, total_rotation)):
+        yield [p.next() for p in projections]
+
+
+def launch_imagej(worker, first_job):
+    """
+    Starts the JVM of an ImageJ worker, running the worker macro from job
+    number first_job. Output from ImageJ goes to worker.log in the spool
+    directory.
+    """
+
+    spool_dir = worker["spool_dir"]
+    log = open(os.path.join(spool_dir, "worker.log"), 'a')
+    # can't use ";" on Mac / Linux. Use "*"
+    macro_args = "*".join([spool_dir + os.sep, str(first_job)])
+    worker["process"] = subprocess.Popen(
+        ["java", "-Xmx1000m", "-jar", IMAGEJPATH, "-batch",
+         worker["macro_path"], macro_args],
+        stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+    worker["current"] = first_job
+    worker["started"] = time.time()
+
+
+def start_imagej_worker(timeout=IMAGEJ_JOB_TIMEOUT,
+                        retries=IMAGEJ_JOB_RETRIES):
+    """
+    Starts a long-lived ImageJ process that runs projection jobs from a
+    spool directory, so that many jobs pay the JVM startup once.
+    Jobs are run in the order they are submitted. A job that takes longer
+    than timeout seconds is killed and fails. If ImageJ exits during a job,
+    it is restarted and the job retried up to 'retries' times.
+
+    @return:        The worker, a dict of its process and job state
+    """
+
+    spool_dir = tempfile.mkdtemp(prefix="imagej_worker_")
+    worker = {"spool_dir": spool_dir,
+              "macro_path": os.path.join(spool_dir, "worker.ijm"),
+              "timeout": timeout, "retries": retries, "next_job": 0,
+              "attempts": {}, "failed": set()}
+    f = open(worker["macro_path"], 'w')
+    f.write(IMAGEJ_WORKER_MACRO)
+    f.close()
+    launch_imagej(worker, 0)
+    return worker
+
+
+def submit_imagej_job(worker, job_args):
+    """
+    Adds a job to the queue of the worker and returns its job number.
+    The job file is written then renamed, so ImageJ never reads half a job.
+    """
+
+    n = worker["next_job"]
+    worker["next_job"] += 1
+    job_path = os.path.join(worker["spool_dir"], "job_%s.txt" % n)
+    f = open(job_path + ".tmp", 'w')
+    f.write("*".join([str(a) for a in job_args]))
+    f.close()
+    os.rename(job_path + ".tmp", job_path)
+    if worker["current"] == n:
+        worker["started"] = time.time()
+    return n
+
+
+def poll_imagej_worker(worker):
+    """
+    Keeps track of the job ImageJ is working on, killing it if it times out
+    and restarting ImageJ if it has exited.
+    """
+
+    def done(n):
+        return os.path.exists(
+            os.path.join(worker["spool_dir"], "job_%s.done" % n))
+
+    # Move on past the jobs that have finished
+    while worker["current"] < worker["next_job"] and \
+            (worker["current"] in worker["failed"] or done(worker["current"])):
+        worker["current"] += 1
+        worker["started"] = time.time()
+    current = worker["current"]
+    if current == worker["next_job"]:
+        return      # Nothing to do
+
+    crashed = worker["process"].poll() is not None
+    timed_out = time.time() - worker["started"] > worker["timeout"]
+    if not crashed and not timed_out:
+        return
+    if crashed:
+        print "ImageJ exited during job %s, restarting" % current
+    else:
+        print "ImageJ job %s timed out, restarting" % current
+        worker["process"].kill()
+        worker["process"].wait()
+    worker["attempts"][current] = worker["attempts"].get(current, 0) + 1
+    if timed_out or worker["attempts"][current] > worker["retries"]:
+        print "ImageJ job %s failed" % current
+        worker["failed"].add(current)
+        current += 1
+    launch_imagej(worker, current)
+
+
+def wait_for_imagej_job(worker, n):
+    """
+    Waits for job n of the worker to finish. Returns True if it succeeded or
+    False if it failed.
+    """
+
+    done_path = os.path.join(worker["spool_dir"], "job_%s.done" % n)
+    while True:
+        if os.path.exists(done_path):
+            return True
+        poll_imagej_worker(worker)
+        if n in worker["failed"]:
+            return False
+        time.sleep(IMAGEJ_POLL_INTERVAL)
+
+
+def stop_imagej_worker(worker):
+    """ Asks the worker to quit, and removes its spool directory """
+
+    n = submit_imagej_job(worker, ["quit"])
+    deadline = time.time() + IMAGEJ_JOB_TIMEOUT
+    while worker["process"].poll() is None and time.time() < deadline:
+        time.sleep(IMAGEJ_POLL_INTERVAL)
+    if worker["process"].poll() is None:
+        worker["process"].kill()
+        worker["process"].wait()
+    print "ImageJ worker ran %s jobs" % n
+    shutil.rmtree(worker["spool_dir"], ignore_errors=True)
+
+
+def get_imagej_stage_dtype(image, useRawData=False):
+    """
+    Returns the type to stage raw data as for ImageJ, or None to keep the
+    pixel type. ImageJ can't import every pixel type as raw data.
+    """
+
+    if useRawData and image.getPixelsType() not in IMAGEJ_RAW_TYPES:
+        # the smallest type ImageJ can import that holds int8 or bit data
+        return 'int16'
+    return None
 
 
-def do_processing(tiff_stack_dir, destination, sizeX, axis="Y"):
+def get_imagej_job(stack, destination, axis="Y", method="Brightest Point",
+                   angle_step=10, total_rotation=360):
     """
-    Here we set-up the ImageJ macro and run it from the command line.
-    We need to know the path to ImageJ jar.
-    The macro text is written to the temp folder that we're running the script
-    in, and the path to the macro is passed to the command line.
+    Returns the arguments of an ImageJ worker job, for the rotation
+    projection of a stack staged by stage_zstack() to the raw file at
+    destination.
     """
 
-    rotation_ijm = """
-str=getArgument();
-args=split(str,"*");
-ippath='%s';
-slices=%s;
-opname="rot_frame";
-oppath=args[1];
+    if stack.ndim == 4:
+        imageType = "24-bit RGB"
+    else:
+        imageType = IMAGEJ_RAW_TYPES[stack.dtype.name]
+    # 0 is transparent for 8-bit data, as in the numpy engine. Other types
+    # use their full range, so no values are lost
+    if stack.dtype.name == 'uint8':
+        lower, upper = 1, 255
+    else:
+        lower, upper = stack.min(), stack.max()
+    return [stack.filename, destination, imageType, stack.shape[2],
+            stack.shape[1], stack.offset, stack.shape[0], method, axis,
+            total_rotation, angle_step, lower, upper]
 
-run("Image Sequence...", "open=&ippath number=&slices starting=1 increment=1 \
-scale=100 file=[] or=[] sort");
-run("3D Project...", "projection=[Brightest Point] axis=%s-Axis slice=1 \
-initial=0 total=360 rotation=10 lower=1 upper=255 opacity=0 surface=100 \
-interior=50");
-run("Image Sequence... ", "format=JPEG name=[&opname] start=0 digits=4 \
-save="+oppath );
-    """ % (tiff_stack_dir, sizeX, axis)
 
-    ijm_path = "rotation.ijm"
+def do_processing(stack, destination, axis="Y", method="Brightest Point",
+                  angle_step=10, total_rotation=360, worker=None):
+    """
+    Here we run the ImageJ rotation projection of a staged stack.
+    The job is run by the ImageJ worker, or by a new worker that is stopped
+    afterwards if worker is None. We need to know the path to ImageJ jar.
+    The worker macro imports the staged .npy stack as raw data and saves the
+    projection as a raw file at destination, with its dimensions in
+    destination.txt, to be read back by load_imagej_output()
+
+    @param stack:           numpy memmap from stage_zstack()
+    @param destination:     Path of the raw output file
+    @param worker:          Worker from start_imagej_worker()
+    @return:                True if ImageJ created the projection
+    """
 
-    # write the macro to a known location that we can pass to ImageJ
-    f = open(ijm_path, 'w')
-    f.write(rotation_ijm)
+    job_args = get_imagej_job(stack, destination, axis, method, angle_step,
+                              total_rotation)
+    if worker is not None:
+        return wait_for_imagej_job(
+            worker, submit_imagej_job(worker, job_args))
+    worker = start_imagej_worker()
+    try:
+        return wait_for_imagej_job(
+            worker, submit_imagej_job(worker, job_args))
+    finally:
+        stop_imagej_worker(worker)
+
+
+def load_imagej_output(destination):
+    """
+    Returns the frames saved by the ImageJ macro as a numpy memmap, (frames,
+    Y, X) or (frames, Y, X, 3) for RGB.
+    """
+
+    f = open(destination + ".txt", 'r')
+    width, height, count, bitDepth = [int(v) for v in f.read().split()]
     f.close()
+    dtype, sizeC = IMAGEJ_OUTPUT_TYPES[bitDepth]
+    shape = (count, height, width)
+    if sizeC > 1:
+        shape += (sizeC,)
+    return memmap(destination, dtype=dtype, mode='r', shape=shape)
+
+
+def get_imagej_output_dtype(image):
+    """
+    Returns the type to convert ImageJ's projections of the raw data of the
+    image back to: the pixel type of the image, or the type it was staged
+    as if ImageJ can't import that.
+    """
+
+    return PIXEL_TYPES.get(image.getPixelsType(),
+                           get_imagej_stage_dtype(image, True))
+
+
+def from_imagej_values(plane, dtype):
+    """
+    Converts a native plane saved by ImageJ back to the raw pixel type
+    dtype. ImageJ imports '16-bit Signed' data with an offset of 32768 and
+    saves it unsigned, and imports 32-bit integers as 32-bit Real.
+    """
+
+    if dtype in ('int8', 'int16') and plane.dtype.name == 'uint16':
+        plane = plane.astype(int32) - 32768
+    elif dtype in ('int32', 'uint32') and plane.dtype.kind == 'f':
+        plane = around(plane)
+    return plane.astype(dtype)
 
-    # Call ImageJ via command line, with macro ijm path & parameters
-    # can't use ";" on Mac / Linu. Use "*"
-    macro_args = "*".join([tiff_stack_dir, destination])
-    cmd = "java -jar %s -batch %s %s -Xmx1000m" \
-        % (IMAGEJPATH, ijm_path, macro_args)
-    os.system(cmd)  # this calls the imagej macro and creates the 36 frames at
-                    # each 10% and are then saved in the destination folder
 
+def split_frames(frames, dtype=None):
+    """
+    Generates a list of 2D planes, one per channel, for each frame of a
+    (frames, Y, X) or (frames, Y, X, C) array, in native byte order.
+    If dtype is given, the planes of (frames, Y, X) raw data saved by ImageJ
+    are converted back to that pixel type with from_imagej_values().
+    """
+
+    native = frames.dtype.newbyteorder('=')
+    for frame in frames:
+        if frame.ndim == 2 and dtype is not None:
+            yield [from_imagej_values(frame.astype(native), dtype)]
+        elif frame.ndim == 2:
+            yield [frame.astype(native)]
+        else:
+            yield [frame[..., c].astype(native)
+                   for c in range(frame.shape[-1])]
 
-def upload_to_omero(conn, destination, imageName, dataset=None):
+
+def upload_projection(conn, output, imageName, dataset=None, wait=None):
     """
-    This creates a new Image in OMERO using all the images in destination
-    folder as Z-planes
+    This creates a new Image in OMERO from a (frames, C, T, Y, X) array of
+    projections, with the frames as Z-planes.
+    If the array is still being written, wait(z, c, t) is called before each
+    plane is read, and should return once that plane is written.
     """
 
-    image_list = os.listdir(destination)
-    image_list = [i for i in image_list if not i.startswith(".")]
-    print "Upload to OMERO:", image_list
+    sizeZ, sizeC, sizeT = output.shape[:3]
 
-    # Create a new Image in OMERO, with the jpeg images as a Z-stack.
     # We need a generator to produce numpy planes in the order Z, C, T.
     def plane_generator():
-        # Start by iterating through Z
-        for i in image_list:
-            print "  Uploading ", i
-            img = Image.open(os.path.join(destination, i))
-            img.load()      # need to get the data in hand before...
-            channels = img.split()
-            for channel in channels:
-                numpyPlane = asarray(channel)
-                yield numpyPlane
-
-    # We're making a Z-stack, so we know the sizeZ
-    newSizeZ = len(image_list)
-
-    # Need to check whether we're dealing with RGB images (3 channels) or
-    # greyscale (1 channel)
-    img = Image.open(os.path.join(destination, image_list[0]))
-    img.load()
-    sizeC = len(img.split())
-
-    # Set group context for Image creation. Shouldn't be needed in scripts
-    # conn.SERVICE_OPTS.setOmeroGroup( image.getDetails().group.id.val )
-
-    # Create the image
-    plane_gen = plane_generator()
+        for z in range(sizeZ):
+            for c in range(sizeC):
+                for t in range(sizeT):
+                    if wait is not None:
+                        wait(z, c, t)
+                    yield output[z, c, t]
+
     dsName = dataset is not None and dataset.getName() or 'None'
-    print "Creating a NEW image: %s  sizeZ: %s  sizeC: %s  in Dataset: %s" \
-        % (imageName, newSizeZ, sizeC, dsName)
+    print "Creating a NEW image: %s  sizeZ: %s  sizeC: %s  sizeT: %s" \
+        "  in Dataset: %s" % (imageName, sizeZ, sizeC, sizeT, dsName)
     newImg = conn.createImageFromNumpySeq(
-        plane_gen, imageName, sizeZ=newSizeZ, sizeC=sizeC, dataset=dataset)
+        plane_generator(), imageName, sizeZ=sizeZ, sizeC=sizeC, sizeT=sizeT,
+        dataset=dataset)
     print "New Image ID", newImg.getId()
     return newImg
 
 
-def process_image(conn, image, tiff_stack_dir, processed_img_dir, axis,
-                  useRawData=False, cIndex=0, region=None):
+def write_projections(projections, output_path, sizeC=1, sizeT=1,
+                      count=None, progress=None):
+    """
+    Writes the projections of the stacks of a job into a (frames, C, T, Y,
+    X) .npy file at output_path, and returns it as a memmap.
+    There is a projection for each stack in the order C then T, e.g. (C0,
+    T0), (C0, T1), (C1, T0)... Each projection is a sequence of frames and
+    each frame is a list of planes, one per channel of the stack, so that
+    rendered RGB stacks give 3 channels.
+
+    @param projections:     Iterable of projections
+    @param output_path:     Path of the .npy file
+    @param sizeC:           Number of channels with a stack
+    @param sizeT:           Number of timepoints
+    @param count:           Number of frames, if projections are generators
+    @param progress:        Called with (k, i, output) after frame i of
+                            projection k is written
+    """
+
+    output = None
+    for k, frames in enumerate(projections):
+        for i, planes in enumerate(frames):
+            sizeRGB = len(planes)
+            if output is None:
+                output = open_memmap(
+                    output_path, mode='w+', dtype=planes[0].dtype,
+                    shape=(count or len(frames), sizeC * sizeRGB, sizeT) +
+                    planes[0].shape)
+            for j, plane in enumerate(planes):
+                output[i, k // sizeT * sizeRGB + j, k % sizeT] = plane
+            if progress is not None:
+                progress(k, i, output)
+    if output is not None:
+        output.flush()
+    return output
+
+
+def stream_projections(conn, projections, output_path, imageName,
+                       dataset=None, sizeC=1, sizeT=1, count=None):
+    """
+    Writes the projections with write_projections() in a background thread
+    while uploading them to a new Image, so that each plane is uploaded as
+    soon as it is projected and uploading overlaps with projecting.
+    Planes are uploaded in the order Z, C, T, so with several stacks each
+    frame is uploaded once every stack has projected it.
+    Returns the new Image, or None if there was nothing to upload.
+    """
+
+    state = {"output": None, "written": {}, "finished": False,
+             "error": None}
+    changed = threading.Condition()
+
+    def progress(k, i, output):
+        changed.acquire()
+        state["output"] = output
+        state["written"][k] = i + 1
+        changed.notifyAll()
+        changed.release()
+
+    def run():
+        try:
+            write_projections(projections, output_path, sizeC, sizeT, count,
+                              progress)
+        except Exception:
+            state["error"] = sys.exc_info()
+        changed.acquire()
+        state["finished"] = True
+        changed.notifyAll()
+        changed.release()
+
+    def wait_for(test):
+        changed.acquire()
+        try:
+            while not test() and not state["finished"]:
+                changed.wait(1)     # a timeout lets Ctrl-C through
+        finally:
+            changed.release()
+        if state["error"] is not None:
+            error = state["error"]
+            raise error[0], error[1], error[2]
+        return test()
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    if not wait_for(lambda: state["output"] is not None):
+        return None     # nothing projected
+    output = state["output"]
+    sizeRGB = output.shape[1] // sizeC
+
+    def wait(z, c, t):
+        k = c // sizeRGB * sizeT + t
+        if not wait_for(lambda: state["written"].get(k, 0) > z):
+            raise Exception("Projection %s has no frame %s" % (k, z))
+
+    newImg = upload_projection(conn, output, imageName, dataset, wait)
+    thread.join()
+    return newImg
+
+
+def get_pixel_region(region, size_x, size_y):
     """
-    Do the whole process for a single image.
-    Download the Z-planes of the input image as separate tiffs into
-    tiff_stack_dir/ call the processing step (output images should be put into
-    processed_img_dir/ )
-    and then create a new Image in OMERO from these images
+    Returns the region (x, y, width, height) in whole pixels, covering every
+    pixel it touches and clipped to the image, or None if it is outside the
+    image. ROI Rectangles have float coordinates.
     """
 
-    dataset = image.getParent()
-    sizeX = image.getSizeX()
+    x, y, width, height = region
+    x1 = max(int(math.floor(x)), 0)
+    y1 = max(int(math.floor(y)), 0)
+    x2 = min(int(math.ceil(x + width)), size_x)
+    y2 = min(int(math.ceil(y + height)), size_y)
+    if x2 <= x1 or y2 <= y1:
+        return None
+    return (x1, y1, x2 - x1, y2 - y1)
+
+
+def get_union_region(regions):
+    """
+    Returns the (x, y, width, height) bounding box of all the regions, which
+    are in whole pixels from get_pixel_region()
+    """
+
+    x = min([r[0] for r in regions])
+    y = min([r[1] for r in regions])
+    width = max([r[0] + r[2] for r in regions]) - x
+    height = max([r[1] + r[3] for r in regions]) - y
+    return (x, y, width, height)
+
+
+def crop_stack(stack, union, region):
+    """
+    Returns a region of a stack staged for the union region, as a numpy view
+    of the staged stack (no copy).
+    """
+
+    x = region[0] - union[0]
+    y = region[1] - union[1]
+    return asarray(stack[:, y:y + region[3], x:x + region[2]])
+
+
+def save_stack(stack, path):
+    """
+    Returns the stack as a .npy memmap that ImageJ or another process can
+    open. Stacks from stage_zstack() are returned as they are, while views
+    from crop_stack() are copied to a new .npy file at path.
+    """
+
+    if isinstance(stack, memmap):
+        return stack
+    staged = open_memmap(path, mode='w+', dtype=stack.dtype,
+                         shape=stack.shape)
+    staged[:] = stack
+    staged.flush()
+    return staged
+
+
+def prefetch(calls, ahead=PREFETCH_STACKS):
+    """
+    Generates the results of each function in calls, in order. The functions
+    are called in a background thread, up to 'ahead' results ahead of the
+    consumer, so that fetching the next stack overlaps with projecting the
+    last one.
+    """
+
+    results = Queue.Queue(ahead)
+    done = object()
+
+    def run():
+        try:
+            for call in calls:
+                results.put((True, call()))
+            results.put((True, done))
+        except Exception:
+            results.put((False, sys.exc_info()))
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    while True:
+        ok, result = results.get()
+        if not ok:
+            raise result[0], result[1], result[2]
+        if result is done:
+            break
+        yield result
+
+
+def iter_staged_stacks(conn, images, use_rois=False, union=True,
+                       useRawData=False, cIndexes=[0], tIndexes=[0],
+                       for_imagej=False, skip=None):
+    """
+    Stages the Z-stacks to project for each image in a temp workspace per
+    image, and generates (image, region, workspace, stacks, sizeC, sizeT)
+    for each projection job. stacks is an iterator over a stack for each
+    channel and timepoint, in the order C then T (just T for rendered data),
+    which are staged by a prefetch thread as they are needed.
+    With ROI regions and union=True, the bounding box of all the regions is
+    fetched once and each stack is cropped from it in memory, so
+    overlapping regions never fetch the same pixels twice.
+
+    @param images:          Iterable of BlitzGateway imageWrappers
+    @param use_rois:        If True, a job for each Rectangle ROI, else one
+                            job for the whole image
+    @param union:           Fetch the union of the regions once
+    @param cIndexes:        Indexes of the channels for raw data
+    @param tIndexes:        Indexes of the timepoints
+    @param for_imagej:      Stage data in a type ImageJ can import
+    @param skip:            Function of (image, region) that returns True if
+                            the job doesn't need doing, e.g. it is cached
+    """
+
+    for image in images:
+        if use_rois:
+            # whole pixels inside the image, for staging and cropping
+            regions = [get_pixel_region(r, image.getSizeX(), image.getSizeY())
+                       for r in get_rects_from_rois(conn, image.getId())]
+            regions = [r for r in regions if r is not None]
+            print "Analysing regions:", regions
+        else:
+            regions = [None]
+        if skip is not None and len(regions) > 0:
+            regions = [r for r in regions if not skip(image, r)]
+            if len(regions) == 0:
+                continue    # nothing left to do
+        channels = [c for c in cIndexes if 0 <= c < image.getSizeC()]
+        timepoints = [t for t in tIndexes if 0 <= t < image.getSizeT()]
+        if not useRawData:
+            channels = [0]      # rendered data has all channels as RGB
+        if len(regions) == 0 or len(channels) == 0 or len(timepoints) == 0:
+            print "Nothing to project for Image:", image.getId()
+            continue
+
+        workspace = tempfile.mkdtemp(prefix="projection_")
+        dtype = None
+        if for_imagej:
+            dtype = get_imagej_stage_dtype(image, useRawData)
+
+        def stage_calls(region, name):
+            return [partial(stage_zstack, image, os.path.join(
+                workspace, "%s_c%s_t%s.npy" % (name, c, t)), useRawData, c,
+                region, dtype, t) for c in channels for t in timepoints]
+
+        if use_rois and union:
+            box = get_union_region(regions)
+            print "Fetching union of regions:", box
+            staged = tee(prefetch(stage_calls(box, "union")), len(regions))
+            for r, stacks in zip(regions, staged):
+                yield (image, r, workspace,
+                       (crop_stack(s, box, r) for s in stacks),
+                       len(channels), len(timepoints))
+        else:
+            for i, r in enumerate(regions):
+                yield (image, r, workspace,
+                       prefetch(stage_calls(r, "stack%s" % i)),
+                       len(channels), len(timepoints))
+
+
+def run_imagej(stack, job_dir, axis, method="Brightest Point",
+               angle_step=10, total_rotation=360, worker=None, name="stack"):
+    """
+    Runs the ImageJ macro on a staged stack, with its files in job_dir/
+    named from name. Returns the projection frames as a memmap, or None if
+    ImageJ failed.
+    """
+
+    stack = save_stack(stack, os.path.join(job_dir, "%s.npy" % name))
+    destination = os.path.join(job_dir, "%s.raw" % name)
+    if not do_processing(stack, destination, axis, method, angle_step,
+                         total_rotation, worker):
+        return None
+    return load_imagej_output(destination)
+
+
+def benchmark_engines(image, region, stack, job_dir, axis,
+                      method="Brightest Point", angle_step=10,
+                      total_rotation=360, worker=None):
+    """
+    Runs the projection of a staged stack with both the numpy engine and the
+    ImageJ macro, and prints the time taken by each. Nothing is uploaded.
+    With a running ImageJ worker, the ImageJ time doesn't include the JVM
+    startup.
+    """
+
+    start = time.time()
+    frames = list(project_stack(stack, axis, angle_step, total_rotation,
+                                method))
+    numpyTime = time.time() - start
+
+    start = time.time()
+    run_imagej(stack, job_dir, axis, method, angle_step, total_rotation,
+               worker, "benchmark")
+    imagejTime = time.time() - start
+
+    print "Benchmark for Image: %s region: %s  %s frames" \
+        % (image.getId(), region, len(frames))
+    print "  NumPy: %.2f secs  ImageJ: %.2f secs" % (numpyTime, imagejTime)
+
+
+def project_stacks_imagej(stacks, job_dir, sizeC, sizeT, axis,
+                          method="Brightest Point", angle_step=10,
+                          total_rotation=360, worker=None, dtype=None):
+    """
+    Projects the stacks of a job with ImageJ, one for each (C, T), and
+    writes them to job_dir/projection.npy with write_projections().
+    Returns the (frames, C, T, Y, X) memmap, or None if ImageJ failed.
+    Raw data is converted back to dtype, see split_frames().
+    """
+
+    failed = []
+
+    def projections():
+        for k, stack in enumerate(stacks):
+            output = run_imagej(stack, job_dir, axis, method, angle_step,
+                                total_rotation, worker, "stack%s" % k)
+            if output is None:
+                failed.append(k)
+                return
+            yield list(split_frames(output, dtype))
+
+    output = write_projections(
+        projections(), os.path.join(job_dir, "projection.npy"), sizeC,
+        sizeT)
+    if failed:
+        return None
+    return output
+
+
+def process_image(conn, image, region, stacks, job_dir, sizeC, sizeT, axis,
+                  engine="NumPy", method="Brightest Point", angle_step=10,
+                  total_rotation=360, worker=None):
+    """
+    Do the whole process for a single image or region, from the staged
+    Z-stack of each channel and timepoint.
+    The stacks are projected either in memory with the 'NumPy' engine or by
+    the ImageJ macro with the 'ImageJ' engine, using job_dir/ for files,
+    then we create a new Image in OMERO from the projection frames, with a
+    channel and timepoint for each stack.
+    With numpy, the frames are uploaded as they are projected.
+    Returns the new Image, or None if ImageJ failed.
+    """
+
+    newImageName = "%s-3D" % image.getName()
+    if engine == "NumPy":
+        return stream_projections(
+            conn, (project_stack(stack, axis, angle_step, total_rotation,
+                                 method) for stack in stacks),
+            os.path.join(job_dir, "projection.npy"), newImageName,
+            image.getParent(), sizeC, sizeT,
+            get_projection_count(angle_step, total_rotation))
+
+    output = project_stacks_imagej(stacks, job_dir, sizeC, sizeT, axis,
+                                   method, angle_step, total_rotation,
+                                   worker, get_imagej_output_dtype(image))
+    if output is None:
+        print "ImageJ failed for Image: %s region: %s" \
+            % (image.getId(), region)
+        return None
+
+    # Create new Image from the projection frames
+    return upload_projection(conn, output, newImageName, image.getParent())
+
+
+def project_staged_stacks(job):
+    """
+    Projects stacks saved by save_stack() with numpy, in a process of the
+    pool used by run_parallel(), with write_projections(). Returns the path
+    of the output .npy file.
+
+    @param job:     Tuple of (stack paths, output path, sizeC, sizeT, axis,
+                    method, angle_step, total_rotation)
+    """
+
+    stack_paths, output_path, sizeC, sizeT, axis, method, angle_step, \
+        total_rotation = job
+    write_projections(
+        (list(project_stack(load(path, mmap_mode='r'), axis, angle_step,
+                            total_rotation, method))
+         for path in stack_paths), output_path, sizeC, sizeT)
+    return output_path
+
+
+def run_parallel(conn, staged, parallel, axis, engine="NumPy",
+                 method="Brightest Point", angle_step=10, total_rotation=360,
+                 workers=None, on_upload=None):
+    """
+    Projects each staged job concurrently, up to 'parallel' jobs at a time,
+    and returns the list of new Images.
+    Each job has its own temp directory in the workspace of its image.
+    Projections with numpy run on a pool of processes, while ImageJ jobs are
+    shared between the ImageJ workers. Uploads are done one at a time, in
+    the order of the jobs, as soon as each projection is ready.
+
+    @param staged:      Generator from iter_staged_stacks()
+    @param parallel:    Max number of jobs to run at once
+    @param workers:     List of ImageJ workers for the 'ImageJ' engine
+    @param on_upload:   Called with (image, region, new Image) after each
+                        upload
+    """
+
+    pool = None
+    if engine == "NumPy":
+        pool = multiprocessing.Pool(parallel)
+    pending = deque()
+    newImages = []
+    # the workspaces we've seen, and the one being staged
+    workspaces = set()
+    staging = {"workspace": None}
+
+    def job_ready(job):
+        if pool is not None:
+            return job["result"].ready()
+        poll_imagej_worker(job["worker"])
+        return not [n for n in job["ns"] if n not in job["worker"]["failed"]
+                    and not os.path.exists(os.path.join(
+                        job["worker"]["spool_dir"], "job_%s.done" % n))]
+
+    def upload_next():
+        job = pending.popleft()
+        image, region = job["image"], job["region"]
+        try:
+            if pool is not None:
+                output = load(job["result"].get(), mmap_mode='r')
+            elif not [n for n in job["ns"]
+                      if not wait_for_imagej_job(job["worker"], n)]:
+                output = write_projections(
+                    (list(split_frames(load_imagej_output(d),
+                                       get_imagej_output_dtype(image)))
+                     for d in job["destinations"]),
+                    os.path.join(job["job_dir"], "projection.npy"),
+                    job["sizeC"], job["sizeT"])
+            else:
+                print "ImageJ failed for Image: %s region: %s" \
+                    % (image.getId(), region)
+                return
+            newImages.append(upload_projection(
+                conn, output, "%s-3D" % image.getName(), image.getParent()))
+            if on_upload is not None:
+                on_upload(image, region, newImages[-1])
+        finally:
+            shutil.rmtree(job["job_dir"], ignore_errors=True)
+            # Remove the image's staged stacks once all its jobs are done
+            workspace = job["workspace"]
+            if workspace != staging["workspace"] and \
+                    workspace not in [j["workspace"] for j in pending]:
+                shutil.rmtree(workspace, ignore_errors=True)
+
+    try:
+        for i, (image, region, workspace, stacks, sizeC, sizeT) in \
+                enumerate(staged):
+            workspaces.add(workspace)
+            staging["workspace"] = workspace
+            job_dir = tempfile.mkdtemp(dir=workspace)
+            job = {"image": image, "region": region, "workspace": workspace,
+                   "job_dir": job_dir, "sizeC": sizeC, "sizeT": sizeT}
+            pending.append(job)
+            stacks = [save_stack(stack, os.path.join(job_dir,
+                                                     "stack%s.npy" % k))
+                      for k, stack in enumerate(stacks)]
+            if pool is not None:
+                job["result"] = pool.apply_async(
+                    project_staged_stacks,
+                    [([stack.filename for stack in stacks],
+                      os.path.join(job_dir, "projection.npy"), sizeC, sizeT,
+                      axis, method, angle_step, total_rotation)])
+            else:
+                job["worker"] = workers[i % len(workers)]
+                job["destinations"] = [
+                    os.path.join(job_dir, "stack%s.raw" % k)
+                    for k in range(len(stacks))]
+                job["ns"] = [submit_imagej_job(job["worker"], get_imagej_job(
+                    stack, d, axis, method, angle_step, total_rotation))
+                    for stack, d in zip(stacks, job["destinations"])]
+            del stacks
+
+            # Upload the jobs that are done, in order, and don't stage more
+            # than 'parallel' jobs ahead of the uploads
+            while pending and (len(pending) > parallel or
+                               job_ready(pending[0])):
+                upload_next()
+
+        staging["workspace"] = None
+        while pending:
+            upload_next()
+        if pool is not None:
+            pool.close()
+            pool.join()
+    finally:
+        for workspace in workspaces:
+            shutil.rmtree(workspace, ignore_errors=True)
+        if pool is not None:
+            pool.terminate()
+
+    return newImages
+
+
+def get_cache_path(conn):
+    """ Returns the path of the projection cache file for the current user """
+    return os.path.join(CACHE_DIR, "cache_user%s.json"
+                        % conn.getEventContext().userId)
+
+
+def load_cache(path):
+    """
+    Loads the projection cache from the file at path, or returns a new empty
+    cache if there is no file.
+    The cache is a dict of key: {'imageId', 'size', 'lastUsed'} for each
+    projection Image, where size is its size in bytes.
+    """
+    if not os.path.exists(path):
+        return {}
+    f = open(path, 'r')
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+
+def save_cache(cache, path):
+    """ Saves the projection cache as json, replacing the file in one go """
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    f = open(path + ".tmp", 'w')
+    json.dump(cache, f)
+    f.close()
+    os.rename(path + ".tmp", path)
+
+
+def get_rendering_version(image):
+    """
+    Returns (rendering def ID, ID of its last update event) for the
+    rendering settings used to render the image. Any change to the settings
+    (model, windows, colours, LUTs, inversion etc.) is a new update event.
+    """
+
+    rdefId = image.getRenderingDefId()
+    params = omero.sys.ParametersI()
+    params.addId(rdefId)
+    rows = image._conn.getQueryService().projection(
+        "select r.details.updateEvent.id from RenderingDef r"
+        " where r.id = :id", params, image._conn.SERVICE_OPTS)
+    return rdefId, unwrap(rows[0][0])
+
+
+def get_cache_key(image, region, useRawData, cIndexes, tIndexes, axis,
+                  engine, method, angle_step, total_rotation):
+    """
+    Returns the cache key of a projection: a hash of the pixels, region and
+    everything else that changes the result, including SCRIPT_VERSION.
+    Rendered data doesn't depend on the channel indexes, but does on the
+    version of the rendering settings, see get_rendering_version().
+    """
 
-    # Depending on what our processing needs, use rendered data or raw pixels
-    # as tiffs
     if useRawData:
-        download_raw_planes(image, tiff_stack_dir, cIndex, region)
+        channels = list(cIndexes)
     else:
-        download_rendered_planes(image, tiff_stack_dir, region)
+        channels = get_rendering_version(image)
+    parts = (image.getPrimaryPixels().getId(), region, useRawData, channels,
+             list(tIndexes), axis, engine, method, angle_step,
+             total_rotation, SCRIPT_VERSION)
+    return hashlib.sha1(repr(parts)).hexdigest()
 
-    # Generate a stack of processed images from input tiffs.
-    do_processing(tiff_stack_dir, processed_img_dir, sizeX, axis)
 
-    # Create new Image from the processed stack of images
-    newImageName = "%s-3D" % image.getName()
-    newImg = upload_to_omero(conn, processed_img_dir, newImageName, dataset)
+def lookup_cache(conn, cache, key):
+    """
+    Returns the cached projection Image for the key, or None. Entries for
+    Images that have been deleted are dropped.
+    """
+
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    image = conn.getObject("Image", entry['imageId'])
+    if image is None:
+        del cache[key]
+        return None
+    entry['lastUsed'] = time.time()
+    return image
 
-    return newImg
+
+def add_to_cache(cache, key, image):
+    """ Adds a new projection Image to the cache """
+
+    itemsize = zeros(0, PIXEL_TYPES.get(image.getPixelsType(), 'float64'))\
+        .itemsize
+    size = image.getSizeX() * image.getSizeY() * image.getSizeZ() * \
+        image.getSizeC() * image.getSizeT() * itemsize
+    cache[key] = {'imageId': image.getId(), 'size': size,
+                  'lastUsed': time.time()}
+
+
+def evict_from_cache(conn, cache, budget, delete=False):
+    """
+    Drops the least recently used entries until the cached Images add up to
+    no more than budget bytes. If delete is True, the Images of the dropped
+    entries are deleted too, otherwise they are just no longer reused.
+    """
+
+    total = sum([e['size'] for e in cache.values()])
+    evicted = []
+    for key, entry in sorted(cache.items(), key=lambda i: i[1]['lastUsed']):
+        if total <= budget:
+            break
+        total -= entry['size']
+        evicted.append(entry['imageId'])
+        del cache[key]
+    if len(evicted) > 0:
+        print "Evicted %s Images from the cache" % len(evicted)
+        if delete:
+            handle = conn.deleteObjects("Image", evicted, deleteAnns=True,
+                                        deleteChildren=True)
+            conn._waitOnCmd(handle)
 
 
 def rotation_proj_stitch(conn, scriptParams):
@@ -277,48 +1353,106 @@ def rotation_proj_stitch(conn, scriptParams):
 
     axis = scriptParams['Rotation_Axis']
     useRawData = scriptParams['Use_Raw_Data']
-    # Convert to zero-based index
-    cIndex = scriptParams['Channel_To_Analyse'] - 1
+    # Convert to zero-based indexes
+    cIndexes = [c - 1 for c in scriptParams.get(
+        'Channels_To_Analyse', [scriptParams['Channel_To_Analyse']])]
+    tIndexes = [t - 1 for t in scriptParams.get('Timepoints', [1])]
     use_rois = scriptParams['Analyse_ROI_Regions']
-
-    current_dir = os.getcwd()
-    tiff_stack_dir = os.path.join(current_dir, "tiff_stack")
-    processed_img_dir = os.path.join(current_dir, "processed_img")
-
-    try:
-        os.mkdir(tiff_stack_dir)
-        os.mkdir(processed_img_dir)
-    except:
-        pass
-
-    def empty_dir(dir_path):
-        for old_file in os.listdir(dir_path):
-            file_path = os.path.join(dir_path, old_file)
-            os.unlink(file_path)
+    union = scriptParams.get('Fetch_Union_Region', True)
+    engine = scriptParams.get('Projection_Engine', "NumPy")
+    method = scriptParams.get('Projection_Method', "Brightest Point")
+    angle_step = scriptParams.get('Angle_Step', 10)
+    total_rotation = scriptParams.get('Total_Rotation', 360)
+    benchmark = scriptParams.get('Benchmark', False)
+    parallel = scriptParams.get('Parallel_Jobs', 1)
+    timeout = scriptParams.get('ImageJ_Timeout', IMAGEJ_JOB_TIMEOUT)
+    use_cache = scriptParams.get('Use_Cache', False)
+    cache_budget = scriptParams.get('Cache_Size_MB', 1024) * 1024 * 1024
+
+    # Projections we've made before are looked up in the cache, by key
+    cache = {}
+    cached = []
+    if use_cache:
+        cache_path = get_cache_path(conn)
+        cache = load_cache(cache_path)
+
+    def get_key(image, region):
+        return get_cache_key(image, region, useRawData, cIndexes, tIndexes,
+                             axis, engine, method, angle_step, total_rotation)
+
+    def is_cached(image, region):
+        existing = lookup_cache(conn, cache, get_key(image, region))
+        if existing is not None:
+            print "Using cached Image: %s for Image: %s region: %s" \
+                % (existing.getId(), image.getId(), region)
+            cached.append(existing)
+        return existing is not None
+
+    def on_upload(image, region, newImg):
+        if use_cache:
+            add_to_cache(cache, get_key(image, region), newImg)
+
+    # A benchmark always projects
+    skip = None
+    if use_cache and not benchmark:
+        skip = is_cached
+
+    # The ImageJ workers run all the ImageJ jobs, starting each JVM once
+    workers = []
+    if engine == "ImageJ":
+        workers = [start_imagej_worker(timeout) for i in range(parallel)]
+    elif benchmark:
+        workers = [start_imagej_worker(timeout)]
+
+    staged = iter_staged_stacks(
+        conn, conn.getObjects("Image", scriptParams['IDs']), use_rois, union,
+        useRawData, cIndexes, tIndexes, len(workers) > 0, skip)
 
     newImages = []
-    for image in conn.getObjects("Image", scriptParams['IDs']):
-
-        # remove input and processed images
-        empty_dir(tiff_stack_dir)
-        empty_dir(processed_img_dir)
-
-        if use_rois:
-            print "Analysing regions:", get_rects_from_rois(
-                conn, image.getId())
-            for r in get_rects_from_rois(conn, image.getId()):
-                newImg = process_image(
-                    conn, image, tiff_stack_dir, processed_img_dir, axis,
-                    useRawData, cIndex, r)
-                newImages.append(newImg)
-
+    try:
+        if parallel > 1 and not benchmark:
+            newImages = run_parallel(
+                conn, staged, parallel, axis, engine, method, angle_step,
+                total_rotation, workers, on_upload)
         else:
-            newImg = process_image(
-                conn, image, tiff_stack_dir, processed_img_dir, axis,
-                useRawData, cIndex)
-            newImages.append(newImg)
+            worker = workers and workers[0] or None
+            # Each image has its own workspace, so script runs can't collide
+            workspaces = set()
+            try:
+                for image, r, workspace, stacks, sizeC, sizeT in staged:
+                    # Done with the workspaces of previous images
+                    for old in workspaces - set([workspace]):
+                        shutil.rmtree(old, ignore_errors=True)
+                    workspaces = set([workspace])
+                    job_dir = tempfile.mkdtemp(dir=workspace)
+                    if benchmark:
+                        stacks = list(stacks)
+                        for stack in stacks:
+                            benchmark_engines(
+                                image, r, stack, job_dir, axis, method,
+                                angle_step, total_rotation, worker)
+                    newImg = process_image(
+                        conn, image, r, stacks, job_dir, sizeC, sizeT, axis,
+                        engine, method, angle_step, total_rotation, worker)
+                    shutil.rmtree(job_dir, ignore_errors=True)
+                    if newImg is not None:
+                        newImages.append(newImg)
+                        on_upload(image, r, newImg)
+            finally:
+                for old in workspaces:
+                    shutil.rmtree(old, ignore_errors=True)
+    finally:
+        for worker in workers:
+            stop_imagej_worker(worker)
+        if use_cache:
+            evict_from_cache(conn, cache, cache_budget,
+                             scriptParams.get('Delete_Evicted', False))
+            save_cache(cache, cache_path)
 
     # Handle what we're returning to client
+    if len(cached) > 0:
+        print "%s projections found in the cache" % len(cached)
+        newImages = cached + newImages
     if len(newImages) == 0:
         return None, "No images created"
     if len(newImages) == 1:
@@ -333,6 +1467,10 @@ def rotation_proj_stitch(conn, scriptParams):
             return None, "Created %s New Images" % len(newImages)
 
 
+# The function doing the work of the script, also called by run_batch
+WORK_FUNCTION = rotation_proj_stitch
+
+
 def runScript():
     """
     The main entry point of the script, as called by the client via the
@@ -341,11 +1479,13 @@ def runScript():
 
     dataTypes = [rstring('Image')]
     axes = [rstring('Y'), rstring('X')]
+    engines = [rstring('NumPy'), rstring('ImageJ')]
+    methods = [rstring(m) for m in PROJECTION_METHODS]
 
     client = scripts.client(
         'ImageJ_Processing.py',
-        """Does ImageJ 'Rotation Projection' macro processing, creating a new\
-Image in OMERO""",
+        """Does 'Rotation Projection' processing, like the ImageJ macro,\
+ creating a new Image in OMERO""",
 
         scripts.String(
             "Data_Type", optional=False, grouping="1",
@@ -363,18 +1503,86 @@ Image in OMERO""",
 
         scripts.Bool(
             "Use_Raw_Data", grouping="4", default=False,
-            description="Convert raw pixel data to Tiff for processing?"
-            " Otherwise use rendered data"),
+            description="Project the raw pixel data, keeping its pixel"
+            " type? Otherwise use rendered RGB data"),
 
         scripts.Int(
             "Channel_To_Analyse", grouping="4.1", default=1, min=1,
-            description="This channel will be analysed as greyscale Tiffs"),
+            description="This channel of the raw data will be projected"),
+
+        scripts.List(
+            "Channels_To_Analyse", grouping="4.2",
+            description="Project these channels of raw data into one new"
+            " Image, instead of Channel_To_Analyse (1 is the first"
+            " channel)").ofType(rint(0)),
+
+        scripts.List(
+            "Timepoints", grouping="4.3",
+            description="Project these timepoints into one new Image (1 is"
+            " the first timepoint). By default the first").ofType(rint(0)),
 
         scripts.Bool(
             "Analyse_ROI_Regions", grouping="5", default=False,
             description="Use Rectangle ROIs to define regions to analyse."
             " By default analyse whole image"),
 
+        scripts.Bool(
+            "Fetch_Union_Region", grouping="5.1", default=True,
+            description="Fetch the bounding box of all the ROI regions once"
+            " and crop each region from it, rather than fetching each"
+            " region"),
+
+        scripts.String(
+            "Projection_Engine", grouping="6", values=engines,
+            default="NumPy",
+            description="Project in memory with NumPy, or with the ImageJ"
+            " macro (needs ImageJ on the server). ImageJ projects 32-bit"
+            " integer data as 32-bit floats, so values above 2^24 may be"
+            " rounded"),
+
+        scripts.String(
+            "Projection_Method", grouping="6.1", values=methods,
+            default="Brightest Point",
+            description="How voxels along each line of sight are combined"),
+
+        scripts.Int(
+            "Angle_Step", grouping="6.2", default=10, min=1,
+            description="Degrees of rotation between frames"),
+
+        scripts.Int(
+            "Total_Rotation", grouping="6.3", default=360, min=1, max=360,
+            description="Degrees of rotation over all frames"),
+
+        scripts.Bool(
+            "Benchmark", grouping="6.4", default=False,
+            description="Also time both engines on each image and print the"
+            " results"),
+
+        scripts.Int(
+            "ImageJ_Timeout", grouping="6.5", default=IMAGEJ_JOB_TIMEOUT,
+            min=1,
+            description="Seconds an ImageJ projection may take before it is"
+            " stopped"),
+
+        scripts.Int(
+            "Parallel_Jobs", grouping="7", default=1, min=1,
+            max=multiprocessing.cpu_count(),
+            description="Number of images or ROI regions to project at"
+            " once. Not used with Benchmark"),
+
+        scripts.Bool(
+            "Use_Cache", grouping="8", default=False,
+            description="Reuse the Image made by a previous run with the"
+            " same data and parameters, instead of making it again"),
+
+        scripts.Int(
+            "Cache_Size_MB", grouping="8.1", default=1024, min=0,
+            description="Max total size of the cached Images. The least"
+            " recently used are dropped from the cache"),
+
+        scripts.Bool(
+            "Delete_Evicted", grouping="8.2", default=False,
+            description="Delete the Images dropped from the cache"),
 
         authors=["William Moore", "Asmi Shah"],
         institutions=["University of Dundee", "KIT"],
@@ -382,16 +1590,18 @@ Image in OMERO""",
     )
 
     try:
+        # process the list of args above, fetching each input once
         scriptParams = {}
-
-        conn = BlitzGateway(client_obj=client)
-
-        # process the list of args above.
         for key in client.getInputKeys():
-            if client.getInput(key):
-                scriptParams[key] = client.getInput(key, unwrap=True)
+            value = client.getInput(key)
+            if value:
+                scriptParams[key] = unwrap(value)
         print scriptParams
 
+        # wrap client to use the Blitz Gateway
+        from omero.gateway import BlitzGateway
+        conn = BlitzGateway(client_obj=client)
+
         robj, message = rotation_proj_stitch(conn, scriptParams)
 
         client.setOutput("Message", rstring(message))
@@ -26,8 +26,7 @@ Flip or Rotate an Image and create a new Image in OMERO
 import omero
 import omero.scripts as scripts
 from numpy import rot90, fliplr, flipud
-from omero.gateway import BlitzGateway
-from omero.rtypes import rint, rlong, rstring, robject
+from omero.rtypes import rint, rlong, rstring, robject, unwrap
 
 
 def rotate90(plane):
@@ -163,6 +162,10 @@ def transformImages(conn, scriptParams):
             return None, "Created %s New Images" % len(newImages)
 
 
+# The function doing the work of the script, also called by run_batch
+WORK_FUNCTION = transformImages
+
+
 def runAsScript():
     client = scripts.client(
         'Transform_Image.py',
@@ -184,15 +187,18 @@ def runAsScript():
     )
 
     try:
-
-        conn = BlitzGateway(client_obj=client)
-
+        # process the list of args above, fetching each input once
         scriptParams = {}
         for key in client.getInputKeys():
-            if client.getInput(key):
-                scriptParams[key] = client.getInput(key, unwrap=True)
+            value = client.getInput(key)
+            if value:
+                scriptParams[key] = unwrap(value)
         print scriptParams
 
+        # wrap client to use the Blitz Gateway
+        from omero.gateway import BlitzGateway
+        conn = BlitzGateway(client_obj=client)
+
         robj, message = transformImages(conn, scriptParams)
 
         client.setOutput("Message", rstring(message))